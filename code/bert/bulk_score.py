@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Scores the whole corpus with the BERT models directly, without going through the HTTP endpoint.
+# The results are written into the request cache of measure_emotions.py, exactly as if endpoint.py had answered its /generate requests.
+# That makes a full re-score a lot faster, and measure_emotions.py then only reads the cache.
+# It's resumable: requests that are in the cache already are skipped, and each cache entry is written in one go.
+# By default, it only scores the texts that measure_emotions.py measures: the ones that match one of its FEATURES. Use --all_texts to score every text.
+# Usage: ./bulk_score.py <directory with the .textcontents.json files> [--cache_path=...] [--models=...] [--all_texts]
+
+from endpoint import Model, KNOWN_MODELS
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from hashlib import sha1
+from glob import glob
+import base64
+import fire
+import json
+import os
+import pickle
+import time
+import torch
+
+# Note: these are the same as in measure_emotions.py.
+HEURISTICS = (
+	".\n" + "anger level: [MASK]",
+	".\n" + "contempt level: [MASK]",
+)
+
+# Note: these are the same as in measure_emotions.py. It only measures the bubbles that match at least one of them.
+FEATURES = [
+	lambda text: (
+		'украин' in text.lower()
+		and any(alt in text.lower() for alt in ('евреи', 'eврейск', 'иудаизм', 'еврей', 'иудей'))	
+	),
+	lambda text: (
+		'украин' in text.lower()
+		and any(alt in text.lower() for alt in ('евреи', 'eврейск', 'иудаизм', 'еврей', 'иудей'))
+		and not any(alt in text.lower() for alt in ('израил', 'газа', 'палестин'))
+	),
+	lambda text: (
+		'россия' in text.lower()
+		and any(alt in text.lower() for alt in ('евреи', 'eврейск', 'иудаизм', 'еврей', 'иудей'))	
+	),
+	lambda text: (
+		'россия' in text.lower()
+		and any(alt in text.lower() for alt in ('евреи', 'eврейск', 'иудаизм', 'еврей', 'иудей'))
+		and not any(alt in text.lower() for alt in ('израил', 'газа', 'палестин'))
+	),
+	lambda text: (
+		'украин' in text.lower()
+		and any(alt in text.lower() for alt in ('чеченцы', 'чеченская', 'чечня', 'чеченец'))
+	),
+	lambda text: (
+		'россия' in text.lower()
+		and any(alt in text.lower() for alt in ('чеченцы', 'чеченская', 'чечня', 'чеченец'))	
+	),
+]
+
+def get_feature_matches(text):
+	return [feature(text) for feature in FEATURES]
+
+# Note: the request has to be built exactly like get_raw_measurement() in measure_emotions.py does, since the cache is keyed by its JSON.
+def get_request_dict(model_name, text):
+	return {
+		"target_tokens": "ALL",
+		"model_name": model_name,
+		"text": text,
+	}
+
+def get_cache_entry_filename(cache_path, req_data):
+	hash_id = sha1(req_data).hexdigest()
+	return cache_path + '/' + hash_id[:2] + '/' + hash_id[2:] + '.json'
+
+def write_cache_entry(filename, req_dict, req_data, resp_body):
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	# Write to a temporary file first, so an interrupted run can't leave a broken cache entry behind.
+	with open(filename + '.tmp', 'w') as outfile:
+		json.dump({
+			'request_data': base64.b64encode(req_data).decode('utf-8'),
+			'request_json': req_dict,
+			'response_body': resp_body,
+			'timestamp': datetime.now(timezone.utc).isoformat(),
+		}, outfile)
+	os.replace(filename + '.tmp', filename)
+
+# Returns the texts that aren't in the cache yet, with their cache entry filenames, for a single model.
+def get_pending_texts(data_dir, cache_path, model_name, heuristics, all_texts=False):
+	pending_texts = {}
+	for filename in sorted(glob('*/*.comments.textcontents.json', root_dir=data_dir)):
+		with open(data_dir + '/' + filename, 'r') as infile:
+			bubbles = json.load(infile)
+		for bubble in bubbles.values():
+			if bubble['filter_reason'] is not None:
+				continue
+			if not all_texts and sum(get_feature_matches(bubble['textcontent'])) == 0:
+				continue
+			for heuristic in heuristics:
+				text = bubble['textcontent'] + heuristic
+				if text in pending_texts:
+					continue
+				cache_entry_filename = get_cache_entry_filename(cache_path, json.dumps(get_request_dict(model_name, text)).encode('utf-8'))
+				if not os.path.exists(cache_entry_filename):
+					pending_texts[text] = cache_entry_filename
+	return pending_texts
+
+# Builds the same response body that /generate in endpoint.py returns.
+def get_response_body(encoding, result):
+	if isinstance(result, Exception):
+		return {
+			'output': None,
+			'error': 'TOO_LARGE',
+			'tokens': encoding.tokens,
+			'mask_token_position': encoding.mask_token_position,
+		}
+	return {
+		'output': base64.b64encode(pickle.dumps(result)).decode('utf-8'),
+		'error': None,
+		'tokens': encoding.tokens,
+		'mask_token_position': encoding.mask_token_position,
+	}
+
+def score_model(model, pending_texts, batch_size, executor):
+	texts = list(pending_texts)
+	encodings = []
+	# Note: the fast tokenizer spreads each call over all cores, so this tokenizes in large chunks.
+	for chunk_start in range(0, len(texts), 4096):
+		encodings += model.encode_batch(texts[chunk_start:chunk_start + 4096])
+	# Texts without a '[MASK]' get a 400 error from the endpoint, which isn't cached, so they're skipped here too.
+	order = [index for index in range(len(texts)) if encodings[index].mask_token_position is not None]
+	skipped_count = len(texts) - len(order)
+	# Sorting by length keeps the padding within each batch small.
+	order.sort(key=lambda index: len(encodings[index].input_ids))
+
+	start_time = time.time()
+	pending_writes = []
+	for batch_number, batch_start in enumerate(range(0, len(order), batch_size)):
+		batch_indices = order[batch_start:batch_start + batch_size]
+		results = model.score_encoded_batch([encodings[index] for index in batch_indices])
+		# Writing the cache entries happens in the background, while the next batch is scored.
+		for index, result in zip(batch_indices, results):
+			text = texts[index]
+			req_dict = get_request_dict(model.model_name, text)
+			pending_writes.append(executor.submit(
+				write_cache_entry,
+				pending_texts[text],
+				req_dict,
+				json.dumps(req_dict).encode('utf-8'),
+				get_response_body(encodings[index], result),
+			))
+		if batch_number % 100 == 0:
+			elapsed = time.time() - start_time
+			done_count = batch_start + len(batch_indices)
+			print(f"'{model.model_name}': {done_count}/{len(order)} texts, {done_count / elapsed if elapsed > 0 else 0:.1f} texts per second")
+		# Don't let the finished writes pile up, but do raise any error that happened while writing.
+		still_pending_writes = []
+		for pending_write in pending_writes:
+			if pending_write.done():
+				pending_write.result()
+			else:
+				still_pending_writes.append(pending_write)
+		pending_writes = still_pending_writes
+	for pending_write in pending_writes:
+		pending_write.result()
+	return len(order), skipped_count
+
+def main(
+		data_dir: str,
+		cache_path: str = '../telegram-scraper/data/request_cache',
+		models: tuple = KNOWN_MODELS,
+		batch_size: int = 64,
+		threads: int = None,
+		writer_threads: int = 4,
+		long_input_strategy: str = 'error',
+		long_input_window_overlap: int = 128,
+		long_input_suffix_length: int = 32,
+		compiled_cache_dir: str = None,
+		quantize: bool = False,
+		all_texts: bool = False,
+):
+	# Note: the cache entries should match what the endpoint would return, so the model settings have to match those of the endpoint.
+	if not os.path.exists(cache_path):
+		raise Exception(f"The location of the cache at '{cache_path}' does not exist.")
+	torch.set_num_threads(threads if threads is not None else os.cpu_count())
+	# Fire passes a single model name (like --models=bert-base-multilingual-cased) as a string, not as a tuple.
+	if isinstance(models, str):
+		models = (models,)
+
+	with ThreadPoolExecutor(max_workers=writer_threads) as executor:
+		for model_name in models:
+			pending_texts = get_pending_texts(data_dir, cache_path, model_name, HEURISTICS, all_texts=all_texts)
+			print(f"'{model_name}': {len(pending_texts)} texts aren't in the cache yet.")
+			if len(pending_texts) == 0:
+				continue
+			model = Model(
+				model_name,
+				long_input_strategy=long_input_strategy,
+				long_input_window_overlap=long_input_window_overlap,
+				long_input_suffix_length=long_input_suffix_length,
+				compiled_cache_dir=compiled_cache_dir,
+				quantize=quantize,
+			)
+			start_time = time.time()
+			scored_count, skipped_count = score_model(model, pending_texts, batch_size, executor)
+			print(f"'{model_name}': scored {scored_count} texts in {time.time() - start_time:.2f} seconds, skipped {skipped_count} without '[MASK]'.")
+
+if __name__ == "__main__":
+	with torch.no_grad():
+		fire.Fire(main)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Compares a dynamically int8 quantized BERT model against the fp32 one on a sample of the scraped comments.
+# It reports how much the label logits at the mask position move, how much that shifts the per-label percentiles
+# (which is what the measurements end up being based on), and how much faster and smaller the quantized model is.
+# Usage: ./check_quantization.py <directory with the .textcontents.json files> [--model_name=...] [--sample_size=...]
+
+from endpoint import Model
+from glob import glob
+import fire
+import json
+import random
+import time
+import torch
+
+# Note: these are the same as in measure_emotions.py.
+HEURISTICS = (
+	".\n" + "anger level: [MASK]",
+	".\n" + "contempt level: [MASK]",
+)
+LABELS = ('high', 'mid', 'low', 'positive', 'neutral', 'negative', 'medium')
+
+def load_sample_texts(data_dir, heuristics, sample_size, seed):
+	textcontents = []
+	for filename in sorted(glob('*/*.comments.textcontents.json', root_dir=data_dir)):
+		with open(data_dir + '/' + filename, 'r') as infile:
+			for bubble in json.load(infile).values():
+				if bubble['filter_reason'] is None:
+					textcontents.append(bubble['textcontent'])
+	if len(textcontents) < 1:
+		raise Exception(f"Could not find any unfiltered textcontents in directory '{data_dir}'.")
+	random.Random(seed).shuffle(textcontents)
+	return [textcontent + heuristic for textcontent in textcontents[:sample_size] for heuristic in heuristics]
+
+# Scores all texts in batches, and returns the label logits (with None for texts that don't fit) and the time it took.
+def score_all(model, texts, target_token_ids, batch_size):
+	results = []
+	start_time = time.perf_counter()
+	for batch_start in range(0, len(texts), batch_size):
+		results += model.score_batch(texts[batch_start:batch_start + batch_size], target_token_ids)
+	seconds = time.perf_counter() - start_time
+	return [None if isinstance(result, Exception) else result for result in results], seconds
+
+# The percentile of each value within its column, like the percentiles that measure_emotions.py derives.
+def get_percentiles(values):
+	ranks = torch.empty_like(values)
+	for column in range(values.shape[1]):
+		ranks[values[:, column].argsort(), column] = torch.arange(values.shape[0], dtype=values.dtype)
+	return ranks / values.shape[0] + 0.5 / values.shape[0]
+
+def get_spearman_correlation(percentiles_a, percentiles_b):
+	a = percentiles_a - percentiles_a.mean(0)
+	b = percentiles_b - percentiles_b.mean(0)
+	return ((a * b).sum(0) / (a.norm(dim=0) * b.norm(dim=0))).tolist()
+
+def main(
+		data_dir: str,
+		model_name: str = 'bert-base-multilingual-cased',
+		sample_size: int = 500,
+		batch_size: int = 16,
+		seed: int = 0,
+		threads: int = None,
+):
+	if threads is not None:
+		torch.set_num_threads(threads)
+	texts = load_sample_texts(data_dir, HEURISTICS, sample_size, seed)
+
+	models = {}
+	logits = {}
+	seconds = {}
+	for name, quantize in (('fp32', False), ('int8', True)):
+		models[name] = Model(model_name, quantize=quantize)
+		models[name].warm_up()
+		target_token_ids = models[name].get_target_token_ids(LABELS)
+		logits[name], seconds[name] = score_all(models[name], texts, target_token_ids, batch_size)
+
+	# Only compare texts that both models could score.
+	kept_indices = [
+		index for index in range(len(texts))
+		if logits['fp32'][index] is not None and logits['int8'][index] is not None
+	]
+	fp32_logits = torch.stack([logits['fp32'][index] for index in kept_indices])
+	int8_logits = torch.stack([logits['int8'][index] for index in kept_indices])
+	fp32_percentiles = get_percentiles(fp32_logits)
+	int8_percentiles = get_percentiles(int8_logits)
+	percentile_shifts = (fp32_percentiles - int8_percentiles).abs()
+
+	report = {
+		'model_name': model_name,
+		'texts': len(texts),
+		'compared_texts': len(kept_indices),
+		'logits': {
+			'max_abs_diff': float((fp32_logits - int8_logits).abs().max()),
+			'mean_abs_diff': float((fp32_logits - int8_logits).abs().mean()),
+			'top_label_agreement': float((fp32_logits.argmax(1) == int8_logits.argmax(1)).float().mean()),
+		},
+		'percentiles': {
+			'mean_abs_shift': float(percentile_shifts.mean()),
+			'max_abs_shift': float(percentile_shifts.max()),
+			'spearman_correlation': dict(zip(LABELS, get_spearman_correlation(fp32_percentiles, int8_percentiles))),
+		},
+		'speed': {
+			'fp32_texts_per_second': len(texts) / seconds['fp32'],
+			'int8_texts_per_second': len(texts) / seconds['int8'],
+			'speedup': seconds['fp32'] / seconds['int8'],
+		},
+		'memory': {
+			'fp32_bytes': models['fp32'].parameter_bytes(),
+			'int8_bytes': models['int8'].parameter_bytes(),
+			'savings': 1 - models['int8'].parameter_bytes() / models['fp32'].parameter_bytes(),
+		},
+	}
+	print(json.dumps(report, indent='\t'))
+
+if __name__ == "__main__":
+	with torch.no_grad():
+		fire.Fire(main)
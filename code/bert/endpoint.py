@@ -1,34 +1,371 @@
 #!/usr/bin/env python3
 
 from flask import Flask, request
-from transformers import BertTokenizer, BertForMaskedLM
+from transformers import AutoTokenizer, BertForMaskedLM
 import fire
 import json
 import pickle
 import base64
-from common.caching import AutoLoader
+import logging
+import os
+import time
+import unicodedata
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from common.caching import AutoLoader, MemoryBudgetedAutoLoader, ResponseCache
+from common.batching import MicroBatchScheduler
+from common.serving import serve_forked_workers
+from common.metrics import ServerMetrics, RequestLog, BATCH_SIZE_BUCKETS, TOKEN_COUNT_BUCKETS
 from torch import no_grad
 
 KNOWN_MODELS = ('bert-base-multilingual-cased','DeepPavlov/rubert-base-cased')
 
+# The maximum number of tokens (including '[CLS]' and '[SEP]') that the models accept.
+MAX_INPUT_LENGTH = 512
+
+# How inputs longer than MAX_INPUT_LENGTH are handled:
+# - 'error': they get a 'TOO_LARGE' error.
+# - 'truncate': tokens are dropped from the start of the text, keeping the end of it (with the heuristic and '[MASK]').
+# - 'window': the text is split into overlapping windows, which each get the end of it appended. The mask logits of the windows are averaged.
+LONG_INPUT_STRATEGIES = ('error', 'truncate', 'window')
+
 app = Flask(__name__)
 
+METRICS = ServerMetrics()
+METRICS.instrument_flask_app(app)
+
+log_request = RequestLog()
+
 class ContextTooLargeException(ValueError):
 	pass
 
+# The result of tokenizing a text once. The human-readable tokens and the mask position are derived from the same input ids.
+# Note: the tokens leave out '[CLS]' and '[SEP]', and mask_token_position is the index of '[MASK]' among them (or None if there isn't one).
+Encoding = namedtuple('Encoding', ['input_ids', 'tokens', 'mask_token_position'])
+
+# The part of BertForMaskedLM that's needed for scoring: the encoder, and the MLM head at the mask positions only.
+# Note: this is what gets traced for the compiled cache, so it only takes and returns tensors.
+#       The decoder isn't applied here, so callers can use just some of its rows.
+class MaskPositionEncoder(torch.nn.Module):
+	def __init__(self, masked_lm_model):
+		super().__init__()
+		self.bert = masked_lm_model.bert
+		self.transform = masked_lm_model.cls.predictions.transform
+		self.decoder = masked_lm_model.cls.predictions.decoder
+
+	def forward(self, input_ids, attention_mask, mask_positions):
+		hidden_states = self.bert(
+			input_ids=input_ids,
+			attention_mask=attention_mask,
+			token_type_ids=torch.zeros_like(input_ids),
+			return_dict=False,
+		)[0]
+		mask_hidden_states = torch.gather(
+			hidden_states,
+			1,
+			mask_positions.view(-1, 1, 1).expand(-1, 1, hidden_states.shape[-1]),
+		).squeeze(1)
+		return self.transform(mask_hidden_states)
+
 # This class is intended to tranparently handle tokenization in a unified manner 
 class Model:
-	def __init__(self, model_name):
-		self.tokenizer = BertTokenizer.from_pretrained(model_name)
-		self.model = BertForMaskedLM.from_pretrained(model_name)
+	# Note: long_input_suffix_length is the number of tokens before '[MASK]' that are always kept for long inputs.
+	#       It should cover the heuristic, and anything more just gets repeated in each window.
+	# Note: with a compiled_cache_dir, the traced MaskPositionEncoder is stored there, and later loaded from there instead of constructing the model.
+	# Note: with quantize, the linear layers of the encoder and head transform run with dynamic int8 quantization.
+	#       The decoder stays in fp32: it's only applied at the mask positions, and its rows need to be selectable.
+	def __init__(self, model_name, long_input_strategy='error', long_input_window_overlap=128, long_input_suffix_length=32, compiled_cache_dir=None, quantize=False):
+		if long_input_strategy not in LONG_INPUT_STRATEGIES:
+			raise ValueError(f"Unknown long input strategy '{long_input_strategy}'. Expected one of {LONG_INPUT_STRATEGIES}.")
+		self.model_name = model_name
+		self.quantize = quantize
+		self.long_input_strategy = long_input_strategy
+		self.long_input_window_overlap = long_input_window_overlap
+		self.long_input_suffix_length = long_input_suffix_length
+		# Note: this uses the fast (Rust) tokenizer whenever the model has one, and falls back to the Python one otherwise.
+		self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+		self._heuristic_ids = {}
+
+		if compiled_cache_dir is not None:
+			# Note: traced modules are tied to the torch version that made them, so that's part of the filename.
+			compiled_filename = os.path.join(compiled_cache_dir, f"{model_name.replace('/', '--')}{'.int8' if quantize else ''}.torch-{torch.__version__}.pt")
+			if os.path.exists(compiled_filename):
+				print(f"Loading compiled '{model_name}' from '{compiled_filename}'.")
+				self.mask_encoder = torch.jit.load(compiled_filename)
+				return
+
+		eager_encoder = MaskPositionEncoder(BertForMaskedLM.from_pretrained(model_name, torchscript=compiled_cache_dir is not None)).eval()
+		if quantize:
+			# Note: this has to be in place. A copy of the encoder would get its own copy of the word embeddings, which the decoder shares.
+			torch.quantization.quantize_dynamic(eager_encoder.bert, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+			torch.quantization.quantize_dynamic(eager_encoder.transform, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+		if compiled_cache_dir is None:
+			self.mask_encoder = eager_encoder
+			return
+
+		print(f"Compiling '{model_name}' to '{compiled_filename}'.")
+		example_input_ids = torch.tensor([self.tokenizer(f"warm-up {self.tokenizer.mask_token}")['input_ids']] * 2)
+		with no_grad():
+			self.mask_encoder = torch.jit.trace(eager_encoder, (
+				example_input_ids,
+				torch.ones_like(example_input_ids),
+				torch.tensor([1, 1]),
+			))
+		os.makedirs(compiled_cache_dir, exist_ok=True)
+		# Write to a temporary file first, so a crash can't leave a broken artifact behind.
+		torch.jit.save(self.mask_encoder, compiled_filename + '.tmp')
+		os.replace(compiled_filename + '.tmp', compiled_filename)
+
+	# Runs a forward pass on a dummy input, so the first real request doesn't pay for any lazy initialization.
+	# Note: this runs twice, because TorchScript optimizes on the second run.
+	def warm_up(self):
+		for _ in range(2):
+			self.score_batch([f"warm-up {self.tokenizer.mask_token}"])
+
+	# Tokenizes all texts in one call, which the fast tokenizer handles in parallel.
+	def encode_batch(self, texts):
+		return [self._make_encoding(input_ids) for input_ids in self.tokenizer(texts)['input_ids']]
+
+	def _make_encoding(self, input_ids):
+		tokens = self.tokenizer.convert_ids_to_tokens(input_ids[1:-1])
+		try:
+			mask_token_position = tokens.index(self.tokenizer.mask_token)
+		except ValueError:
+			mask_token_position = None
+		return Encoding(input_ids, tokens, mask_token_position)
+
+	# The input ids of a heuristic on its own, without '[CLS]' and '[SEP]'. There are only a few heuristics, so these are kept around.
+	def _get_heuristic_ids(self, heuristic):
+		if heuristic not in self._heuristic_ids:
+			self._heuristic_ids[heuristic] = self.tokenizer(heuristic, add_special_tokens=False)['input_ids']
+		return self._heuristic_ids[heuristic]
+
+	# Encodes one text with each of the heuristics appended, while tokenizing the text only once.
+	# Note: the tokenizer always splits at whitespace and punctuation, so for heuristics that start with either,
+	#       this gives the same input ids as encoding the text and heuristic together. Other heuristics are encoded together with the text.
+	def encode_heuristics(self, text, heuristics):
+		text_ids = self.tokenizer(text, add_special_tokens=False)['input_ids']
+		encodings = []
+		for heuristic in heuristics:
+			if len(heuristic) == 0 or heuristic[0].isspace() or unicodedata.category(heuristic[0]).startswith('P'):
+				encodings.append(self._make_encoding(
+					[self.tokenizer.cls_token_id] + text_ids + self._get_heuristic_ids(heuristic) + [self.tokenizer.sep_token_id]
+				))
+			else:
+				encodings.append(self.encode(text + heuristic))
+		return encodings
+
+	# The memory taken up by the weights (and buffers) of the model.
+	# Note: this goes over the state_dict rather than the parameters, because the packed int8 weights of quantized layers aren't parameters.
+	#       Their state_dict entries are (weight, bias) tuples, next to non-tensor entries like their dtype.
+	#       Traced modules leave the packed weights out of their state_dict, so those are unpacked from the modules themselves.
+	#       Tied weights (like the decoder and the word embeddings) are in the state_dict under each name, so they're only counted once.
+	def parameter_bytes(self):
+		state_dict = self.mask_encoder.state_dict()
+		values = list(state_dict.values())
+		for name, module in self.mask_encoder.named_modules():
+			if name.endswith('_packed_params') and f'{name}._packed_params' not in state_dict:
+				values.append(module._weight_bias())
+		tensors = {}
+		for value in values:
+			for tensor in value if isinstance(value, tuple) else (value,):
+				if isinstance(tensor, torch.Tensor):
+					tensors[tensor.data_ptr()] = tensor
+		return sum(tensor.numel() * tensor.element_size() for tensor in tensors.values())
+
+	def encode(self, text):
+		return self.encode_batch([text])[0]
 
 	def __call__(self, text):
-		encoded_input = self.tokenizer(text, return_tensors='pt')
-		if encoded_input['input_ids'].shape[1] > 512:
-			raise ContextTooLargeException()
-		raw_output = self.model(**encoded_input)
-		# TODO: return the interesting parts of the result
-		return raw_output
+		result = self.score_encoded_batch([self.encode(text)])[0]
+		if isinstance(result, Exception):
+			raise result
+		return result
+
+	def score_batch(self, texts, target_token_ids=None):
+		return self.score_encoded_batch(self.encode_batch(texts), target_token_ids)
+
+	# Maps token strings to their ids, or raises a KeyError for tokens that aren't in the vocab.
+	def get_target_token_ids(self, target_tokens):
+		if target_tokens == 'ALL':
+			return None
+		vocab = self.tokenizer.vocab
+		return [vocab[target_token] for target_token in target_tokens]
+
+	# Splits up an encoding that's too long according to the long_input_strategy. Returns a list of encodings that fit.
+	# The list is empty if the encoding can't be made to fit.
+	# Note: this works on the input ids directly, so nothing is tokenized again. The returned encodings don't have tokens.
+	def fit_encoding(self, encoding):
+		if len(encoding.input_ids) <= MAX_INPUT_LENGTH:
+			return [encoding]
+		if self.long_input_strategy == 'error':
+			return []
+
+		# Split the ids (without '[CLS]' and '[SEP]') into the start of the text, and the end that must be kept.
+		mask_token_index = encoding.mask_token_position + 1
+		suffix_start = max(1, mask_token_index - self.long_input_suffix_length)
+		body = encoding.input_ids[1:suffix_start]
+		suffix = encoding.input_ids[suffix_start:-1]
+		body_length = MAX_INPUT_LENGTH - 2 - len(suffix)
+		if body_length <= 0:
+			return []
+
+		if self.long_input_strategy == 'truncate':
+			chunks = [body[-body_length:]]
+		elif self.long_input_strategy == 'window':
+			stride = max(1, body_length - self.long_input_window_overlap)
+			chunks = [body[start:start + body_length] for start in range(0, max(1, len(body) - body_length + stride), stride)]
+		return [
+			Encoding(
+				[encoding.input_ids[0]] + chunk + suffix + [encoding.input_ids[-1]],
+				None,
+				len(chunk) + mask_token_index - suffix_start,
+			)
+			for chunk in chunks
+		]
+
+	# Applies the decoder of the MLM head to the transformed hidden states at the mask positions.
+	# Only the rows of the target_token_ids are used, if there are any.
+	# This gives the same logits as the full BertForMaskedLM output at those positions.
+	def _predict(self, transformed_hidden_states, target_token_ids=None):
+		decoder = self.mask_encoder.decoder
+		if target_token_ids is None:
+			return torch.nn.functional.linear(transformed_hidden_states, decoder.weight, decoder.bias)
+		return torch.nn.functional.linear(
+			transformed_hidden_states,
+			decoder.weight[target_token_ids],
+			decoder.bias[target_token_ids],
+		)
+
+	# Runs a single padded forward pass over all encodings, and returns the logits at the mask position of each one.
+	# Only that position is projected onto the vocabulary, and only onto the target_token_ids if those are given.
+	# Encodings that are too large get a ContextTooLargeException instead, so the MicroBatchScheduler raises it to only that caller.
+	# Note: like generate() always did, this returns the row at mask_token_position, which counts from the token after '[CLS]'.
+	#       In the encoded input, that's the token right before '[MASK]'. This is kept as-is, so results match the existing request caches.
+	@no_grad()
+	def score_encoded_batch(self, encodings, target_token_ids=None):
+		# Long encodings can turn into several windows, which all go into the same forward pass.
+		fitted_encodings = []
+		owners = []
+		for index, encoding in enumerate(encodings):
+			for fitted_encoding in self.fit_encoding(encoding):
+				fitted_encodings.append(fitted_encoding)
+				owners.append(index)
+		results = [ContextTooLargeException() if index not in owners else None for index in range(len(encodings))]
+		if len(fitted_encodings) > 0:
+			batch_length = max(len(encoding.input_ids) for encoding in fitted_encodings)
+			input_ids = torch.full((len(fitted_encodings), batch_length), self.tokenizer.pad_token_id, dtype=torch.long)
+			attention_mask = torch.zeros((len(fitted_encodings), batch_length), dtype=torch.long)
+			for row, encoding in enumerate(fitted_encodings):
+				input_ids[row, :len(encoding.input_ids)] = torch.tensor(encoding.input_ids)
+				attention_mask[row, :len(encoding.input_ids)] = 1
+			transformed_hidden_states = self.mask_encoder(
+				input_ids,
+				attention_mask,
+				torch.tensor([encoding.mask_token_position for encoding in fitted_encodings]),
+			)
+			logits = self._predict(transformed_hidden_states, target_token_ids)
+			owners = torch.tensor(owners)
+			for index in range(len(encodings)):
+				if results[index] is None:
+					# Note: this also clones, so pickling the result only stores this row, not the logits of the whole batch.
+					results[index] = logits[owners == index].mean(dim=0)
+		return results
+
+	# Scores each text with all of the heuristics, in a single forward pass over one sequence per text.
+	# The text is only in that sequence once, followed by each heuristic (with its own '[SEP]').
+	# The tokens of each heuristic attend to the text and to that heuristic, and are positioned right after the text, as if it was the only one.
+	# The tokens of the text only attend to the text. This is the difference from scoring text + heuristic on its own:
+	# there, the text also attends to the heuristic, which is why the text has to be encoded again for each heuristic.
+	# So, the results are close to, but not the same as, those of score_encoded_batch(), and they shouldn't be mixed with those.
+	# Returns a list (one per text) of lists (one per heuristic) of logits.
+	# Note: texts that don't fit fall back to score_encoded_batch(), so they're handled according to the long_input_strategy.
+	@no_grad()
+	def score_shared_context_batch(self, texts, heuristics, target_token_ids=None):
+		if isinstance(self.mask_encoder, torch.jit.ScriptModule):
+			raise ValueError("Scoring with a shared context needs the eager model, so it can't be used with a compiled_cache_dir.")
+		heuristic_ids = [self._get_heuristic_ids(heuristic) for heuristic in heuristics]
+		for heuristic, ids in zip(heuristics, heuristic_ids):
+			if self.tokenizer.mask_token_id not in ids:
+				raise ValueError(f"The heuristic '{heuristic}' contains no '{self.tokenizer.mask_token}' token.")
+
+		results = [None] * len(texts)
+		sequences = []
+		for index, text_ids in enumerate(self.tokenizer(texts, add_special_tokens=False)['input_ids']):
+			context_length = 1 + len(text_ids)
+			if context_length + max(len(ids) for ids in heuristic_ids) + 1 > MAX_INPUT_LENGTH:
+				results[index] = self.score_encoded_batch(self.encode_heuristics(texts[index], heuristics), target_token_ids)
+				continue
+			input_ids = [self.tokenizer.cls_token_id] + text_ids
+			position_ids = list(range(context_length))
+			branches = []
+			gather_positions = []
+			for ids in heuristic_ids:
+				branch_start = len(input_ids)
+				input_ids += ids + [self.tokenizer.sep_token_id]
+				position_ids += range(context_length, context_length + len(ids) + 1)
+				branches.append((branch_start, len(input_ids)))
+				# Note: like score_encoded_batch(), this takes the row right before '[MASK]'.
+				gather_positions.append(branch_start + ids.index(self.tokenizer.mask_token_id) - 1)
+			sequences.append((index, input_ids, position_ids, context_length, branches, gather_positions))
+
+		if len(sequences) > 0:
+			batch_length = max(len(input_ids) for (index, input_ids, position_ids, context_length, branches, gather_positions) in sequences)
+			input_ids_tensor = torch.full((len(sequences), batch_length), self.tokenizer.pad_token_id, dtype=torch.long)
+			position_ids_tensor = torch.zeros((len(sequences), batch_length), dtype=torch.long)
+			# Note: padding rows don't attend to anything. They're never gathered, so that doesn't matter.
+			attention_mask = torch.zeros((len(sequences), batch_length, batch_length), dtype=torch.long)
+			for row, (index, input_ids, position_ids, context_length, branches, gather_positions) in enumerate(sequences):
+				input_ids_tensor[row, :len(input_ids)] = torch.tensor(input_ids)
+				position_ids_tensor[row, :len(position_ids)] = torch.tensor(position_ids)
+				attention_mask[row, :context_length, :context_length] = 1
+				for branch_start, branch_end in branches:
+					attention_mask[row, branch_start:branch_end, :context_length] = 1
+					attention_mask[row, branch_start:branch_end, branch_start:branch_end] = 1
+			hidden_states = self.mask_encoder.bert(
+				input_ids=input_ids_tensor,
+				attention_mask=attention_mask,
+				token_type_ids=torch.zeros_like(input_ids_tensor),
+				position_ids=position_ids_tensor,
+				return_dict=False,
+			)[0]
+			gather_rows = torch.tensor([row for row in range(len(sequences)) for _ in heuristics])
+			gather_columns = torch.tensor([position for sequence in sequences for position in sequence[5]])
+			logits = self._predict(self.mask_encoder.transform(hidden_states[gather_rows, gather_columns]), target_token_ids)
+			for row, sequence in enumerate(sequences):
+				# Note: this clones, so pickling one result doesn't store the logits of the whole batch.
+				results[sequence[0]] = [logits[row * len(heuristics) + column].clone() for column in range(len(heuristics))]
+		return results
+
+	# The batch callable for the MicroBatchScheduler. Each item is an (encoding, target_token_ids) tuple.
+	# The batch is projected onto the union of the requested tokens, or onto the whole vocab if any item asks for 'ALL'.
+	def score_scheduled_batch(self, items):
+		if any(target_token_ids is None for (encoding, target_token_ids) in items):
+			batch_token_ids = None
+		else:
+			batch_token_ids = sorted(set(token_id for (encoding, target_token_ids) in items for token_id in target_token_ids))
+		results = self.score_encoded_batch([encoding for (encoding, target_token_ids) in items], batch_token_ids)
+		for index, (encoding, target_token_ids) in enumerate(items):
+			if isinstance(results[index], Exception) or target_token_ids is None or target_token_ids == batch_token_ids:
+				continue
+			elif batch_token_ids is None:
+				results[index] = results[index][target_token_ids]
+			else:
+				results[index] = results[index][[batch_token_ids.index(token_id) for token_id in target_token_ids]]
+		return results
+
+def get_response_cache_key(model_name, encoding, target_token_ids, shared_context=False):
+	key = (
+		RESPONSE_CACHE_NAMESPACE,
+		model_name,
+		tuple(encoding.input_ids),
+		tuple(target_token_ids) if target_token_ids is not None else 'ALL',
+	)
+	# Note: results with a shared context differ a little, so they're kept apart.
+	if shared_context:
+		key += ('shared_context',)
+	return key
 
 @app.route("/generate", methods=['POST'])
 def generate():
@@ -48,44 +385,156 @@ def generate():
 		)
 	):
 		return {"error":"malformed request"}, 400
-	print('Got request', request.json)
+	log_request('Got request', request.json)
+
+	text = request.json['text']
+	model_name = request.json['model_name']
+
+	warnings = []
+	if model_name not in KNOWN_MODELS:
+		warnings.append(f"Model '{model_name}' isn't known. Using anyways, but there might be issues.")
+		log_request("WARNING:", warnings[-1])
+
+	# Return an error if loading the requested model fails.
+	if model_name not in MODELS:
+		try:
+			MODELS[model_name]
+		except:
+			METRICS.count('errors', route='/generate', model=model_name, error='MODEL_LOAD')
+			return {"error": f"Could not load model '{model_name}'.", "warnings": warnings}
+
+	encoding = MODELS[model_name].encode(text)
+	METRICS.observe('tokens_per_request', len(encoding.input_ids), buckets=TOKEN_COUNT_BUCKETS, model=model_name)
+	if encoding.mask_token_position is None:
+		return {"error": "text contains no '[MASK]' token", "warnings": warnings}, 400
+	try:
+		target_token_ids = MODELS[model_name].get_target_token_ids(request.json['target_tokens'])
+	except KeyError as e:
+		return {"error": f"target token {e} is not in the vocab of model '{model_name}'", "warnings": warnings}, 400
+
+	# Note: the cache stores the encoded output, so a hit doesn't touch the model, and doesn't pickle anything either.
+	response_cache_key = get_response_cache_key(model_name, encoding, target_token_ids)
+	output = RESPONSE_CACHE.get(response_cache_key)
+	METRICS.count('response_cache_lookups', model=model_name, result='miss' if output is None else 'hit')
+	if output is None:
+		try:
+			mask_token_logits = SCHEDULERS[model_name]((encoding, target_token_ids))
+		except ContextTooLargeException:
+			log_request("Context was too large. Returning 'TOO_LARGE' error.")
+			METRICS.count('errors', route='/generate', model=model_name, error='TOO_LARGE')
+			return {
+				'output': None,
+				'error': 'TOO_LARGE',
+				'tokens': encoding.tokens,
+				'mask_token_position': encoding.mask_token_position,
+			}
+		log_request('Returning result', mask_token_logits)
+		output = base64.b64encode(pickle.dumps(mask_token_logits)).decode('utf-8')
+		RESPONSE_CACHE.put(response_cache_key, output)
+	else:
+		log_request('Returning cached result')
+
+	# Note: with a list of target_tokens, the output only has their logits, in the requested order.
+	return {
+		'output': output,
+		'error': None,
+		'tokens': encoding.tokens,
+		'mask_token_position': encoding.mask_token_position,
+	}
+
+# Like /generate, but for one text with each of several heuristics appended. The text is only tokenized once.
+# By default, the texts with each heuristic are scored as separate rows of a batch, so the results are the same as with /generate.
+# With 'shared_context', the text is encoded only once for all heuristics instead. See Model.score_shared_context_batch().
+@app.route("/generate_heuristics", methods=['POST'])
+def generate_heuristics():
+	if not (
+		type(request.json) == dict
+		and 'text' in request.json
+		and type(request.json['text']) == str
+		and 'heuristics' in request.json
+		and type(request.json['heuristics']) == list
+		and len(request.json['heuristics']) > 0
+		and all(type(heuristic) == str for heuristic in request.json['heuristics'])
+		and 'model_name' in request.json
+		and type(request.json['model_name']) == str
+		and 'target_tokens' in request.json
+		and (
+			request.json['target_tokens'] == 'ALL'
+			or (
+				type(request.json['target_tokens']) == list
+				and all(type(target_token) == str for target_token in request.json['target_tokens'])
+			)
+		)
+		and type(request.json.get('shared_context', False)) == bool
+	):
+		return {"error":"malformed request"}, 400
+	log_request('Got request', request.json)
 
 	text = request.json['text']
+	heuristics = request.json['heuristics']
 	model_name = request.json['model_name']
+	shared_context = request.json.get('shared_context', False)
 
 	warnings = []
 	if model_name not in KNOWN_MODELS:
 		warnings.append(f"Model '{model_name}' isn't known. Using anyways, but there might be issues.")
-		print("WARNING:", warnings[-1])
+		log_request("WARNING:", warnings[-1])
 
 	# Return an error if loading the requested model fails.
 	if model_name not in MODELS:
 		try:
 			MODELS[model_name]
 		except:
+			METRICS.count('errors', route='/generate_heuristics', model=model_name, error='MODEL_LOAD')
 			return {"error": f"Could not load model '{model_name}'.", "warnings": warnings}
 
-	tokens = MODELS[model_name].tokenizer.tokenize(text)
-	mask_token_position = tokens.index('[MASK]')
+	model = MODELS[model_name]
+	encodings = model.encode_heuristics(text, heuristics)
+	for encoding in encodings:
+		METRICS.observe('tokens_per_request', len(encoding.input_ids), buckets=TOKEN_COUNT_BUCKETS, model=model_name)
+	if any(encoding.mask_token_position is None for encoding in encodings):
+		return {"error": "text with heuristic contains no '[MASK]' token", "warnings": warnings}, 400
 	try:
-		results = MODELS[model_name](text)
-	except ContextTooLargeException:
-		print("Context was too large. Returning 'TOO_LARGE' error.")
-		return {
-			'output': None,
-			'error': 'TOO_LARGE',
-			'tokens': tokens,
-			'mask_token_position': mask_token_position,
-		}
-
-	print('Returning result', results)
-	# TODO: have callers request only a subset of logits.
+		target_token_ids = model.get_target_token_ids(request.json['target_tokens'])
+	except KeyError as e:
+		return {"error": f"target token {e} is not in the vocab of model '{model_name}'", "warnings": warnings}, 400
+
+	response_cache_keys = [get_response_cache_key(model_name, encoding, target_token_ids, shared_context) for encoding in encodings]
+	outputs = [RESPONSE_CACHE.get(response_cache_key) for response_cache_key in response_cache_keys]
+	for output in outputs:
+		METRICS.count('response_cache_lookups', model=model_name, result='miss' if output is None else 'hit')
+	missing_indices = [index for index, output in enumerate(outputs) if output is None]
+	if len(missing_indices) > 0:
+		if shared_context:
+			# Note: the text is encoded once either way, so this just scores all heuristics again.
+			try:
+				results = model.score_shared_context_batch([text], heuristics, target_token_ids)[0]
+			except ValueError as e:
+				return {"error": str(e), "warnings": warnings}, 400
+		else:
+			# Submitting them all at once lets the scheduler put them in the same batch.
+			futures = {index: SCHEDULERS[model_name].submit((encodings[index], target_token_ids)) for index in missing_indices}
+			results = {}
+			for index, future in futures.items():
+				try:
+					results[index] = future.result()
+				except ContextTooLargeException as e:
+					results[index] = e
+		for index in missing_indices:
+			if isinstance(results[index], ContextTooLargeException):
+				METRICS.count('errors', route='/generate_heuristics', model=model_name, error='TOO_LARGE')
+				continue
+			outputs[index] = base64.b64encode(pickle.dumps(results[index])).decode('utf-8')
+			RESPONSE_CACHE.put(response_cache_keys[index], outputs[index])
+	log_request('Returning results for', len(heuristics), 'heuristics')
+
+	# Note: heuristics that make the input too large get a None output and a 'TOO_LARGE' error.
 	return {
-		# 'output': base64.b64encode(pickle.dumps(results.logits)).decode('utf-8'),
-		'output': base64.b64encode(pickle.dumps(results.logits[0][mask_token_position])).decode('utf-8'),
+		'outputs': outputs,
+		'errors': [None if output is not None else 'TOO_LARGE' for output in outputs],
 		'error': None,
-		'tokens': tokens,
-		'mask_token_position': mask_token_position,
+		'tokens': [encoding.tokens for encoding in encodings],
+		'mask_token_positions': [encoding.mask_token_position for encoding in encodings],
 	}
 
 @app.route("/tokenize", methods=['POST'])
@@ -98,7 +547,7 @@ def tokenize():
 		and type(request.json['model_name']) == str
 	):
 		return {"error":"malformed request"}, 400
-	print('Got request', request.json)
+	log_request('Got request', request.json)
 
 	text = request.json['text']
 	model_name = request.json['model_name']
@@ -106,24 +555,34 @@ def tokenize():
 	warnings = []
 	if model_name not in KNOWN_MODELS:
 		warnings.append(f"Model '{model_name}' isn't known. Using anyways, but there might be issues.")
-		print("WARNING:", warnings[-1])
+		log_request("WARNING:", warnings[-1])
 
 	# Return an error if loading the requested model fails.
 	if model_name not in MODELS:
 		try:
 			MODELS[model_name]
 		except:
+			METRICS.count('errors', route='/tokenize', model=model_name, error='MODEL_LOAD')
 			return {"error": f"Could not load model '{model_name}'.", "warnings": warnings}
 
 	tokenization = MODELS[model_name].tokenizer(text, return_tensors='pt')
 	human_readable_tokenization = MODELS[model_name].tokenizer.tokenize(text)
 
-	print('Returning tokenization', tokenization)
+	log_request('Returning tokenization', tokenization)
 	return {
 		'output': base64.b64encode(pickle.dumps(tokenization)).decode('utf-8'),
 		'human_readable': human_readable_tokenization,
 	}
 
+# Note: this is a view of the gauges in /metrics, with just the state of the models, schedulers and response cache.
+@app.route("/stats", methods=['GET'])
+def stats():
+	return METRICS.read_gauges(['models', 'schedulers', 'response_cache'])
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+	return METRICS.to_dict()
+
 @app.route("/vocab", methods=['POST'])
 def vocab():
 	if not (
@@ -132,39 +591,134 @@ def vocab():
 		and type(request.json['model_name']) == str
 	):
 		return {"error":"malformed request"}, 400
-	print('Got request', request.json)
+	log_request('Got request', request.json)
 
 	model_name = request.json['model_name']
 
 	warnings = []
 	if model_name not in KNOWN_MODELS:
 		warnings.append(f"Model '{model_name}' isn't known. Using anyways, but there might be issues.")
-		print("WARNING:", warnings[-1])
+		log_request("WARNING:", warnings[-1])
 
 	# Return an error if loading the requested model fails.
 	if model_name not in MODELS:
 		try:
 			MODELS[model_name]
 		except:
+			METRICS.count('errors', route='/vocab', model=model_name, error='MODEL_LOAD')
 			return {"error": f"Could not load model '{model_name}'.", "warnings": warnings}
 
 	vocab = MODELS[model_name].tokenizer.vocab
 
-	print('Returning vocab of', model_name)
+	log_request('Returning vocab of', model_name)
 	return {
 		'output': vocab,
 	}
 
+def score_scheduled_batch(model_name, items):
+	METRICS.observe('batch_size', len(items), buckets=BATCH_SIZE_BUCKETS, model=model_name)
+	with METRICS.timed('batch_latency_seconds', model=model_name):
+		return MODELS[model_name].score_scheduled_batch(items)
+
 def main(
-	port: int
+	port: int,
+	max_batch_size: int = 16,
+	max_wait_ms: float = 5.0,
+	long_input_strategy: str = 'error',
+	long_input_window_overlap: int = 128,
+	long_input_suffix_length: int = 32,
+	model_memory_budget_gb: float = 4.0,
+	preload_models: tuple = KNOWN_MODELS,
+	compiled_cache_dir: str = None,
+	quantize: bool = False,
+	response_cache_mb: float = 256.0,
+	response_cache_dir: str = None,
+	quiet: bool = False,
+	workers: int = 1,
+	intra_op_threads: int = None,
+	host: str = '127.0.0.1',
 ):
-	global MODELS
-	MODELS = AutoLoader(Model)
+	global MODELS, SCHEDULERS, RESPONSE_CACHE, RESPONSE_CACHE_NAMESPACE
+	log_request.verbose = not quiet
+	if quiet:
+		# The access log of the server is a print per request too.
+		logging.getLogger('werkzeug').setLevel(logging.WARNING)
+	start_time = time.time()
+	if long_input_strategy not in LONG_INPUT_STRATEGIES:
+		raise ValueError(f"Unknown long input strategy '{long_input_strategy}'. Expected one of {LONG_INPUT_STRATEGIES}.")
+	# Fire passes a single model name (like --preload_models=bert-base-multilingual-cased) as a string, not as a tuple.
+	if isinstance(preload_models, str):
+		preload_models = (preload_models,)
+	if workers > 1:
+		# Split the cores between the workers by default, so they don't fight over them.
+		if intra_op_threads is None:
+			intra_op_threads = max(1, (os.cpu_count() or 1) // workers)
+		# Note: the parent process only loads the weights. It must not use a multithreaded OpenMP pool before forking,
+		#       since the workers can hang on an inherited one (with GNU OpenMP). The workers set their own number of threads.
+		torch.set_num_threads(1)
+	elif intra_op_threads is not None:
+		torch.set_num_threads(intra_op_threads)
+	# Clients can ask for any model, so the least recently used ones are unloaded once they take up more than model_memory_budget_gb.
+	MODELS = MemoryBudgetedAutoLoader(
+		lambda model_name: Model(
+			model_name,
+			long_input_strategy=long_input_strategy,
+			long_input_window_overlap=long_input_window_overlap,
+			long_input_suffix_length=long_input_suffix_length,
+			compiled_cache_dir=compiled_cache_dir,
+			quantize=quantize,
+		),
+		size_callable=lambda model: model.parameter_bytes(),
+		budget_bytes=int(model_memory_budget_gb * 1024**3) if model_memory_budget_gb is not None else None,
+	)
+	# Concurrent /generate requests for the same model are grouped into batches of up to max_batch_size.
+	# A batch waits at most max_wait_ms for more requests, so raising it trades latency for throughput.
+	# Note: the scheduler looks up the model for every batch, so it doesn't keep evicted models in memory.
+	SCHEDULERS = AutoLoader(lambda model_name: MicroBatchScheduler(
+		lambda items: score_scheduled_batch(model_name, items),
+		max_batch_size=max_batch_size,
+		max_wait=max_wait_ms / 1000,
+	))
+
+	# Identical /generate requests are answered from a cache of up to response_cache_mb, without running the model.
+	# With a response_cache_dir, the cache is also kept on disk, so it survives restarts and is shared between servers that use the same directory.
+	# Note: the settings that change the logits are part of the keys, so servers with different settings never share entries.
+	RESPONSE_CACHE = ResponseCache(
+		size_callable=len,
+		budget_bytes=int(response_cache_mb * 1024**2),
+		disk_path=response_cache_dir,
+	)
+	RESPONSE_CACHE_NAMESPACE = (long_input_strategy, long_input_window_overlap, long_input_suffix_length, quantize)
+
+	METRICS.register_gauge('queue_depth', lambda: {model_name: scheduler.queue_depth() for model_name, scheduler in SCHEDULERS.items()})
+	METRICS.register_gauge('loaded_model_bytes', lambda: {loaded['key']: loaded['bytes'] for loaded in MODELS.get_stats()['loaded']})
+	METRICS.register_gauge('models', MODELS.get_stats)
+	METRICS.register_gauge('schedulers', lambda: {model_name: scheduler.get_stats() for model_name, scheduler in SCHEDULERS.items()})
+	METRICS.register_gauge('response_cache', RESPONSE_CACHE.get_stats)
+
+	# Preload the models in parallel to speed up the first calls after a reset, and keep them loaded.
+	if len(preload_models) > 0:
+		with ThreadPoolExecutor(max_workers=len(preload_models)) as executor:
+			if workers > 1:
+				list(executor.map(MODELS.pin, preload_models))
+			else:
+				list(executor.map(lambda model_name: MODELS.pin(model_name).warm_up(), preload_models))
+	print(f"Ready in {time.time() - start_time:.2f} seconds")
 
-	# Preload BERT to speed up the first call after a reset
-	MODELS['bert-base-multilingual-cased']
+	if workers == 1:
+		app.run(host=host, port=port)
+		return
 
-	app.run(port=port)
+	# Each worker serves requests on its own, so Python-side work isn't serialized anymore.
+	# The preloaded weights are shared copy-on-write between the workers, so they're only in memory once.
+	# Note: models that a worker loads later on (and its schedulers, response cache and metrics) are private to that worker.
+	#       Use a response_cache_dir to share cached responses between workers.
+	def initialize_worker():
+		torch.set_num_threads(intra_op_threads)
+		METRICS.register_gauge('worker_pid', os.getpid)
+		for model_name in preload_models:
+			MODELS[model_name].warm_up()
+	serve_forked_workers(app, host, port, workers, worker_initializer=initialize_worker)
 
 if __name__ == "__main__":
 	with no_grad():
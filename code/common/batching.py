@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+# Groups items submitted from concurrent callers into batches, and runs the batch_callable on each batch from a single worker thread.
+# A batch is closed when it reaches max_batch_size, or when its oldest item has waited for max_wait seconds.
+# The batch_callable gets a list of items and must return a list of results in the same order.
+# Note: a result that is an exception instance is raised to that item's caller only, instead of being returned.
+class MicroBatchScheduler:
+	def __init__(self, batch_callable, max_batch_size=16, max_wait=0.005, stats_window=10000):
+		if max_batch_size < 1:
+			raise ValueError(f"Expected max_batch_size to be at least 1, but got {max_batch_size}.")
+		self._batch_callable = batch_callable
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait
+
+		self._queue = deque()
+		self._condition = threading.Condition()
+
+		# Note: the latencies and batch sizes only cover the last stats_window requests and batches.
+		self._latencies = deque(maxlen=stats_window)
+		self._batch_sizes = deque(maxlen=stats_window)
+		self._completed_count = 0
+		self._batch_count = 0
+		self._started_at = time.monotonic()
+
+		self._worker = threading.Thread(target=self._run, daemon=True)
+		self._worker.start()
+
+	def submit(self, item) -> Future:
+		future = Future()
+		with self._condition:
+			self._queue.append((item, future, time.monotonic()))
+			self._condition.notify()
+		return future
+
+	def __call__(self, item):
+		return self.submit(item).result()
+
+	def queue_depth(self):
+		with self._condition:
+			return len(self._queue)
+
+	def _take_batch(self):
+		with self._condition:
+			while len(self._queue) == 0:
+				self._condition.wait()
+			deadline = self._queue[0][2] + self.max_wait
+			while len(self._queue) < self.max_batch_size:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				self._condition.wait(remaining)
+			return [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch_size))]
+
+	def _run(self):
+		while True:
+			batch = self._take_batch()
+			try:
+				results = self._batch_callable([item for (item, future, enqueued_at) in batch])
+				if len(results) != len(batch):
+					raise ValueError(f"Expected {len(batch)} results from the batch callable, but got {len(results)}.")
+			except Exception as e:
+				for (item, future, enqueued_at) in batch:
+					future.set_exception(e)
+			else:
+				for (item, future, enqueued_at), result in zip(batch, results):
+					if isinstance(result, Exception):
+						future.set_exception(result)
+					else:
+						future.set_result(result)
+			finished_at = time.monotonic()
+			with self._condition:
+				self._latencies.extend(finished_at - enqueued_at for (item, future, enqueued_at) in batch)
+				self._batch_sizes.append(len(batch))
+				self._completed_count += len(batch)
+				self._batch_count += 1
+
+	def get_stats(self):
+		with self._condition:
+			latencies = sorted(self._latencies)
+			batch_sizes = list(self._batch_sizes)
+			completed_count = self._completed_count
+			batch_count = self._batch_count
+			queue_depth = len(self._queue)
+		uptime = time.monotonic() - self._started_at
+		return {
+			'max_batch_size': self.max_batch_size,
+			'max_wait_seconds': self.max_wait,
+			'completed_requests': completed_count,
+			'completed_batches': batch_count,
+			'queue_depth': queue_depth,
+			'requests_per_second': completed_count / uptime if uptime > 0 else None,
+			'mean_batch_size': sum(batch_sizes) / len(batch_sizes) if batch_sizes else None,
+			'p50_latency_seconds': latencies[int(0.50 * (len(latencies) - 1))] if latencies else None,
+			'p99_latency_seconds': latencies[int(0.99 * (len(latencies) - 1))] if latencies else None,
+		}
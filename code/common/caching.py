@@ -1,19 +1,234 @@
+import os
+import pickle
+import tempfile
+import threading
+from hashlib import sha1
+from collections import OrderedDict
 from collections.abc import Mapping
 
 # This class loads the results of the source_callable on demand.
 # It's essentially just a cache.
 # But, note that other code uses it for "caching" things like currently loaded models too!
+# It's safe to use from multiple threads: concurrent first requests for the same key wait on a single call of the source_callable.
+# If that call raises, the exception is raised to all of them, and nothing is cached, so the next request tries again.
 class AutoLoader(Mapping):
 	def __init__(self, source_callable):
 		self._inner = {}
 		self._source_callable = source_callable
+		# Note: this lock only guards the dicts. The source_callable runs without it, so different keys can load in parallel.
+		self._lock = threading.RLock()
+		self._pending = {}
 	def __getitem__(self, key):
+		with self._lock:
+			try:
+				return self._inner.__getitem__(key)
+			except KeyError:
+				pass
+			pending_load = self._pending.get(key)
+			is_loading_thread = pending_load is None
+			if is_loading_thread:
+				pending_load = _PendingLoad()
+				self._pending[key] = pending_load
+		if not is_loading_thread:
+			return pending_load.wait()
 		try:
-			return self._inner.__getitem__(key)
-		except KeyError:
-			self._inner[key] = self._source_callable(key)
-			return self._inner.__getitem__(key)
+			value = self._source_callable(key)
+		except BaseException as e:
+			with self._lock:
+				del self._pending[key]
+			pending_load.fail(e)
+			raise
+		with self._lock:
+			self._inner[key] = value
+			del self._pending[key]
+		pending_load.succeed(value)
+		return value
 	def __iter__(self):
-		return self._inner.__iter__()
+		with self._lock:
+			return iter(list(self._inner))
 	def __len__(self):
 		return self._inner.__len__()
+
+# A load of a single key that's in progress. Other threads that want the same key wait on it.
+class _PendingLoad:
+	def __init__(self):
+		self._event = threading.Event()
+		self._value = None
+		self._exception = None
+	def succeed(self, value):
+		self._value = value
+		self._event.set()
+	def fail(self, exception):
+		self._exception = exception
+		self._event.set()
+	def wait(self):
+		self._event.wait()
+		if self._exception is not None:
+			raise self._exception
+		return self._value
+
+# An AutoLoader for things that take up a lot of memory, like models.
+# Each loaded value is measured with size_callable, and the least recently used values are evicted once the total exceeds budget_bytes.
+# Pinned keys are never evicted.
+# Note: a value that is still in use elsewhere stays in memory until that's done, even after it's evicted here.
+# Note: the size of a value is only known after loading it, so eviction happens after the load. Leave room for one more value in the budget.
+# Note: a value that exceeds the budget on its own is still kept (it's the most recently used one), but everything else that isn't pinned gets evicted.
+class MemoryBudgetedAutoLoader(AutoLoader):
+	def __init__(self, source_callable, size_callable, budget_bytes=None):
+		super().__init__(source_callable)
+		self._size_callable = size_callable
+		self.budget_bytes = budget_bytes
+		self._sizes = {}
+		self._last_used = OrderedDict()
+		self._pinned = set()
+		self.eviction_count = 0
+	def __getitem__(self, key):
+		value = super().__getitem__(key)
+		with self._lock:
+			if key not in self._inner:
+				# It got evicted by another thread in the meantime.
+				return value
+			if key not in self._sizes:
+				self._sizes[key] = self._size_callable(value)
+			self._last_used[key] = None
+			self._last_used.move_to_end(key)
+			self._evict(keep=key)
+		return value
+	def total_bytes(self):
+		with self._lock:
+			return sum(self._sizes.values())
+	def _evict(self, keep):
+		if self.budget_bytes is None:
+			return
+		for key in list(self._last_used):
+			if self.total_bytes() <= self.budget_bytes:
+				break
+			if key == keep or key in self._pinned:
+				continue
+			self.evict(key)
+	def evict(self, key):
+		with self._lock:
+			if key in self._pinned:
+				raise ValueError(f"Cannot evict '{key}', because it's pinned.")
+			del self._inner[key]
+			del self._sizes[key]
+			del self._last_used[key]
+			self.eviction_count += 1
+	# Loads the value if it isn't loaded already, and keeps it loaded.
+	def pin(self, key):
+		with self._lock:
+			self._pinned.add(key)
+		return self[key]
+	def unpin(self, key):
+		with self._lock:
+			self._pinned.discard(key)
+			self._evict(keep=None)
+	def get_stats(self):
+		with self._lock:
+			return {
+				'budget_bytes': self.budget_bytes,
+				'total_bytes': self.total_bytes(),
+				'eviction_count': self.eviction_count,
+				# Note: these are ordered from least to most recently used.
+				'loaded': [
+					{
+						'key': key,
+						'bytes': self._sizes[key],
+						'pinned': key in self._pinned,
+					}
+					for key in self._last_used
+				],
+			}
+
+# A least recently used cache, bounded by the total size of its values in bytes, as measured by size_callable.
+# With a disk_path, every entry is also written there, in the same sha1 layout as the request cache of measure_emotions.py.
+# Entries that were evicted from memory, or that were cached by an earlier run, are then read back from disk instead of being computed again.
+# Note: the disk filenames are based on the pickled keys, so keys should be simple values like strings, ints and tuples of those.
+class ResponseCache:
+	def __init__(self, size_callable, budget_bytes, disk_path=None):
+		self._size_callable = size_callable
+		self.budget_bytes = budget_bytes
+		self.disk_path = disk_path
+		self._entries = OrderedDict()
+		self._total_bytes = 0
+		self._lock = threading.Lock()
+		self.memory_hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+		self.eviction_count = 0
+		if disk_path is not None:
+			os.makedirs(disk_path, exist_ok=True)
+
+	def _get_disk_filename(self, key):
+		hash_id = sha1(pickle.dumps(key)).hexdigest()
+		return os.path.join(self.disk_path, hash_id[:2], hash_id[2:] + '.pickle')
+
+	# Returns the cached value, or default if there is none.
+	def get(self, key, default=None):
+		with self._lock:
+			if key in self._entries:
+				self._entries.move_to_end(key)
+				self.memory_hits += 1
+				return self._entries[key][0]
+		if self.disk_path is not None:
+			try:
+				with open(self._get_disk_filename(key), 'rb') as infile:
+					value = pickle.load(infile)
+			except FileNotFoundError:
+				pass
+			except (pickle.UnpicklingError, EOFError, ValueError) as e:
+				print(f"Ignoring broken response cache file '{self._get_disk_filename(key)}': {e}")
+			else:
+				with self._lock:
+					self.disk_hits += 1
+				self._put_in_memory(key, value)
+				return value
+		with self._lock:
+			self.misses += 1
+		return default
+
+	def put(self, key, value):
+		self._put_in_memory(key, value)
+		if self.disk_path is not None:
+			filename = self._get_disk_filename(key)
+			os.makedirs(os.path.dirname(filename), exist_ok=True)
+			# Write to a temporary file first, so concurrent readers never see a partial entry.
+			# Note: the temporary file gets a unique name, since forked workers can share the disk_path and write the same entry.
+			with tempfile.NamedTemporaryFile(dir=os.path.dirname(filename), suffix='.tmp', delete=False) as outfile:
+				try:
+					pickle.dump(value, outfile)
+				except BaseException:
+					outfile.close()
+					os.remove(outfile.name)
+					raise
+			os.replace(outfile.name, filename)
+
+	def _put_in_memory(self, key, value):
+		size = self._size_callable(value)
+		with self._lock:
+			if key in self._entries:
+				self._total_bytes -= self._entries.pop(key)[1]
+			# A value that's larger than the whole budget is only kept on disk.
+			if size > self.budget_bytes:
+				return
+			self._entries[key] = (value, size)
+			self._total_bytes += size
+			while self._total_bytes > self.budget_bytes:
+				evicted_key, (evicted_value, evicted_size) = self._entries.popitem(last=False)
+				self._total_bytes -= evicted_size
+				self.eviction_count += 1
+
+	def get_stats(self):
+		with self._lock:
+			lookups = self.memory_hits + self.disk_hits + self.misses
+			return {
+				'budget_bytes': self.budget_bytes,
+				'total_bytes': self._total_bytes,
+				'entries': len(self._entries),
+				'disk_path': self.disk_path,
+				'memory_hits': self.memory_hits,
+				'disk_hits': self.disk_hits,
+				'misses': self.misses,
+				'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else None,
+				'eviction_count': self.eviction_count,
+			}
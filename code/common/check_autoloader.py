@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Stress tests the single-flight loading of AutoLoader and MemoryBudgetedAutoLoader from many threads at once.
+# For each round, all threads ask for the same key at the same moment, and it checks that:
+# - the key is loaded exactly once, and every thread gets that same value,
+# - when the load raises, the exception reaches every thread that was waiting on it,
+# - and the next request after a failed load loads it again, and succeeds.
+# Usage: ./check_autoloader.py [--threads=...] [--rounds=...]
+
+from caching import AutoLoader, MemoryBudgetedAutoLoader
+import fire
+import threading
+import time
+
+class LoadFailure(Exception):
+	pass
+
+# A source_callable that counts its calls per key, takes load_seconds, and raises on the first load of the keys in failing_keys.
+class CountingSource:
+	def __init__(self, load_seconds, failing_keys=()):
+		self.load_seconds = load_seconds
+		self.failing_keys = set(failing_keys)
+		self.calls = {}
+		self._lock = threading.Lock()
+
+	def __call__(self, key):
+		with self._lock:
+			self.calls[key] = self.calls.get(key, 0) + 1
+			should_fail = key in self.failing_keys and self.calls[key] == 1
+		time.sleep(self.load_seconds)
+		if should_fail:
+			raise LoadFailure(f"The first load of '{key}' fails.")
+		return object()
+
+def check(condition, message):
+	if not condition:
+		raise Exception(f"Check failed: {message}")
+
+# Has all threads get the key at the same moment, and returns what each of them got: either the value or the exception.
+def get_from_all_threads(loader, key, threads):
+	barrier = threading.Barrier(threads)
+	outcomes = [None] * threads
+	def get(index):
+		barrier.wait()
+		try:
+			outcomes[index] = loader[key]
+		except Exception as e:
+			outcomes[index] = e
+	workers = [threading.Thread(target=get, args=(index,)) for index in range(threads)]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	return outcomes
+
+def check_loader(name, make_loader, threads, rounds, load_seconds):
+	for round_number in range(rounds):
+		source = CountingSource(load_seconds, failing_keys=('failing',))
+		loader = make_loader(source)
+
+		outcomes = get_from_all_threads(loader, 'working', threads)
+		check(source.calls.get('working') == 1, f"{name}: expected 1 load of 'working', but got {source.calls.get('working')}.")
+		check(all(outcome is outcomes[0] for outcome in outcomes), f"{name}: not every thread got the same value.")
+		check(not isinstance(outcomes[0], Exception), f"{name}: the load of 'working' failed with {outcomes[0]!r}.")
+
+		outcomes = get_from_all_threads(loader, 'failing', threads)
+		check(source.calls.get('failing') == 1, f"{name}: expected 1 failed load of 'failing', but got {source.calls.get('failing')}.")
+		failed_count = sum(isinstance(outcome, LoadFailure) for outcome in outcomes)
+		check(failed_count == threads, f"{name}: the exception reached {failed_count} of {threads} threads.")
+		check('failing' not in list(loader), f"{name}: the failed load was cached.")
+
+		outcomes = get_from_all_threads(loader, 'failing', threads)
+		check(source.calls.get('failing') == 2, f"{name}: expected the retry to load 'failing' once more, but it was loaded {source.calls.get('failing')} times.")
+		check(all(outcome is outcomes[0] and not isinstance(outcome, Exception) for outcome in outcomes), f"{name}: the retry didn't give every thread the same value.")
+	print(f"{name}: {rounds} rounds with {threads} threads passed.")
+
+def main(
+		threads: int = 64,
+		rounds: int = 20,
+		load_seconds: float = 0.01,
+):
+	check_loader('AutoLoader', AutoLoader, threads, rounds, load_seconds)
+	check_loader('MemoryBudgetedAutoLoader', lambda source: MemoryBudgetedAutoLoader(source, lambda value: 1, budget_bytes=10), threads, rounds, load_seconds)
+
+if __name__ == "__main__":
+	fire.Fire(main)
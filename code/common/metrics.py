@@ -0,0 +1,141 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets. The last bucket of each histogram catches everything larger.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+TOKEN_COUNT_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+# Note: this is also used for the stage latencies in the run reports of measure_emotions.py (through a symlink in its lib).
+class Histogram:
+	def __init__(self, buckets):
+		self._buckets = buckets
+		self._counts = [0] * (len(buckets) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.max = None
+
+	def observe(self, value):
+		self._counts[bisect_left(self._buckets, value)] += 1
+		self.count += 1
+		self.total += value
+		self.max = value if self.max is None else max(self.max, value)
+
+	# Note: this estimates the quantile as the upper bound of the bucket it falls in, so it's only as precise as the buckets.
+	def quantile(self, q):
+		if self.count == 0:
+			return None
+		threshold = q * self.count
+		running = 0
+		for upper_bound, count in zip(self._buckets, self._counts):
+			running += count
+			if running >= threshold:
+				return upper_bound
+		return self.max
+
+	def to_dict(self):
+		return {
+			'count': self.count,
+			'sum': self.total,
+			'mean': self.total / self.count if self.count else None,
+			'max': self.max,
+			'p50': self.quantile(0.5),
+			'p99': self.quantile(0.99),
+			'buckets': {
+				**{f"le_{upper_bound}": count for upper_bound, count in zip(self._buckets, self._counts)},
+				'le_inf': self._counts[-1],
+			},
+		}
+
+
+# Runtime telemetry of a model server: counters and histograms that are split up by labels (like route and model),
+# and gauges, which are callables that are evaluated whenever the metrics are read.
+# It's safe to use from multiple threads.
+class ServerMetrics:
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._counters = {}
+		self._histograms = {}
+		self._gauges = {}
+		self._started_at = time.monotonic()
+
+	def count(self, name, amount=1, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self._counters[key] = self._counters.get(key, 0) + amount
+
+	def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			if key not in self._histograms:
+				self._histograms[key] = Histogram(buckets)
+			self._histograms[key].observe(value)
+
+	@contextmanager
+	def timed(self, name, **labels):
+		start_time = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start_time, **labels)
+
+	def register_gauge(self, name, gauge_callable):
+		with self._lock:
+			self._gauges[name] = gauge_callable
+
+	def read_gauges(self, names):
+		with self._lock:
+			gauges = {name: self._gauges[name] for name in names if name in self._gauges}
+		return {name: gauge_callable() for name, gauge_callable in gauges.items()}
+
+	# Counts every request, and measures its latency, split up by route, model and status code.
+	# The model is taken from the 'model_name' field of JSON requests, if there is one.
+	def instrument_flask_app(self, app):
+		from flask import g, request
+
+		@app.before_request
+		def start_timer():
+			g.metrics_start_time = time.perf_counter()
+
+		@app.after_request
+		def record_request(response):
+			route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+			request_json = request.get_json(silent=True) if request.is_json else None
+			model_name = request_json.get('model_name') if type(request_json) == dict else None
+			self.count('requests', route=route, model=model_name, status=response.status_code)
+			if response.status_code >= 400:
+				self.count('errors', route=route, model=model_name, error=str(response.status_code))
+			if 'metrics_start_time' in g:
+				self.observe('request_latency_seconds', time.perf_counter() - g.metrics_start_time, route=route, model=model_name)
+			return response
+
+	def to_dict(self):
+		with self._lock:
+			counters = dict(self._counters)
+			histograms = {key: histogram.to_dict() for key, histogram in self._histograms.items()}
+			gauges = dict(self._gauges)
+		result = {
+			'uptime_seconds': time.monotonic() - self._started_at,
+			'counters': {},
+			'histograms': {},
+			'gauges': {name: gauge_callable() for name, gauge_callable in gauges.items()},
+		}
+		for (name, labels), value in counters.items():
+			result['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+		for (name, labels), histogram in histograms.items():
+			result['histograms'].setdefault(name, []).append({'labels': dict(labels), **histogram})
+		return result
+
+
+# Prints what a server does with each request, like log_request('Got request', request.json).
+# Printing every request and result is slow under load, so the servers turn it off with their --quiet switch, by setting verbose.
+class RequestLog:
+	def __init__(self, verbose=True):
+		self.verbose = verbose
+
+	def __call__(self, *args):
+		if self.verbose:
+			print(*args)
@@ -0,0 +1,43 @@
+import os
+import signal
+import socket
+
+# Serves a Flask app from several worker processes, which are forked from the current process and share a single listening socket.
+# Anything loaded before calling this (like model weights) is shared copy-on-write, so as long as the workers only read it,
+# there is only one copy of it in memory. Each worker runs worker_initializer first, and then serves requests from multiple threads.
+# If any worker exits, the others are stopped too, and this returns.
+def serve_forked_workers(app, host, port, workers, worker_initializer=None):
+	from werkzeug.serving import make_server
+
+	listening_socket = socket.create_server((host, port), backlog=128)
+	worker_pids = []
+	try:
+		for _ in range(workers):
+			pid = os.fork()
+			if pid == 0:
+				exit_code = 1
+				try:
+					if worker_initializer is not None:
+						worker_initializer()
+					make_server(host, port, app, threaded=True, fd=listening_socket.fileno()).serve_forever()
+					exit_code = 0
+				except KeyboardInterrupt:
+					exit_code = 0
+				finally:
+					# Note: the worker must never return into the code of the parent process.
+					os._exit(exit_code)
+			worker_pids.append(pid)
+		print(f"Serving on http://{host}:{port} with {workers} worker processes: {worker_pids}")
+		pid, status = os.wait()
+		print(f"Worker {pid} exited with status {status}. Stopping the other workers.")
+		worker_pids.remove(pid)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		for pid in worker_pids:
+			try:
+				os.kill(pid, signal.SIGTERM)
+				os.waitpid(pid, 0)
+			except (ProcessLookupError, ChildProcessError):
+				pass
+		listening_socket.close()
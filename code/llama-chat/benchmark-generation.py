@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Measures the generation speed of llama.model.Transformer in tokens per second, on a small model with random weights.
+# The model is run like LLaMA.generate_internals() runs it: the prompt in one forward pass, and then one forward pass per token.
+# It defaults to the CPU, so it also runs on machines without a GPU.
+
+import fire
+import os
+import time
+import torch
+from llama.model import ModelArgs, Transformer
+
+DTYPES = {
+	'float32': torch.float32,
+	'bfloat16': torch.bfloat16,
+	'float16': torch.float16,
+}
+
+def main(
+		device: str = 'cpu',
+		dtype: str = 'float32',
+		dim: int = 512,
+		n_layers: int = 8,
+		n_heads: int = 8,
+		vocab_size: int = 32000,
+		batch_size: int = 1,
+		prompt_length: int = 64,
+		generated_tokens: int = 64,
+		max_seq_len: int = None,
+		threads: int = None,
+		seed: int = 0,
+):
+	if device == 'cpu':
+		torch.set_num_threads(threads if threads is not None else os.cpu_count())
+	torch.manual_seed(seed)
+	torch.set_default_dtype(DTYPES[dtype])
+	model_args = ModelArgs(
+		dim=dim,
+		n_layers=n_layers,
+		n_heads=n_heads,
+		vocab_size=vocab_size,
+		max_batch_size=batch_size,
+		max_seq_len=max_seq_len or prompt_length + generated_tokens,
+		device=device,
+	)
+	model = Transformer(model_args)
+	# Note: the layers are created with skip_init(), so their weights would be whatever was in memory.
+	with torch.no_grad():
+		for parameter in model.parameters():
+			if parameter.dim() > 1:
+				parameter.normal_(std=0.02)
+	model.eval()
+
+	tokens = torch.randint(0, vocab_size, (batch_size, prompt_length + generated_tokens))
+	start_time = time.perf_counter()
+	model.forward(tokens[:, :prompt_length], 0)
+	prompt_seconds = time.perf_counter() - start_time
+
+	start_time = time.perf_counter()
+	for cur_pos in range(prompt_length, prompt_length + generated_tokens):
+		logits = model.forward(tokens[:, cur_pos - 1:cur_pos], cur_pos - 1)
+		tokens[:, cur_pos] = torch.argmax(logits, dim=-1).cpu()
+	generation_seconds = time.perf_counter() - start_time
+
+	print(f"Device: {device}, dtype: {dtype}, threads: {torch.get_num_threads()}, parameters: {sum(parameter.numel() for parameter in model.parameters())}")
+	print(f"Prompt:     {batch_size * prompt_length} tokens in {prompt_seconds:.3f} seconds ({batch_size * prompt_length / prompt_seconds:.1f} tokens per second)")
+	print(f"Generation: {batch_size * generated_tokens} tokens in {generation_seconds:.3f} seconds ({batch_size * generated_tokens / generation_seconds:.1f} tokens per second)")
+	# The KV caches grow with the sequence length, so this is compared to what caches of max_seq_len would take.
+	max_kv_cache_bytes = 2 * n_layers * batch_size * model_args.max_seq_len * dim * torch.finfo(DTYPES[dtype]).bits // 8
+	print(f"KV cache:   {model.kv_cache_bytes() / 2**20:.1f} MiB, out of {max_kv_cache_bytes / 2**20:.1f} MiB at max_seq_len {model_args.max_seq_len}")
+
+if __name__ == "__main__":
+	fire.Fire(main)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# Times a single step of the repetition penalty in LLaMA.generate_internals(), for the vectorized version and the loop it replaced.
+# It also checks that both give exactly the same logits.
+# The tokens are laid out like in generate_internals(): the prompt and the generated tokens, then padding, and the eos at the end.
+
+import fire
+import time
+import torch
+from llama.generation import apply_repetition_penalty
+
+PAD_ID = -1
+
+# The per-row loop that generate_internals() used before.
+def apply_repetition_penalty_loop(logits, tokens, repetition_penalty):
+	logits_new = logits.clone()
+	batch_size = len(tokens)
+	for i in range(batch_size):
+		for token in set(tokens[i].tolist()):
+			if logits[i, token] < 0:
+				logits_new[i, token] = logits[i, token] * repetition_penalty
+			else:
+				logits_new[i, token] = logits[i, token] / repetition_penalty
+	return logits_new
+
+def time_per_step(function, logits, tokens, repetition_penalty, repeats):
+	function(logits, tokens, repetition_penalty)
+	start_time = time.perf_counter()
+	for _ in range(repeats):
+		function(logits, tokens, repetition_penalty)
+	return (time.perf_counter() - start_time) / repeats
+
+def main(
+		batch_size: int = 1,
+		context_length: int = 2048,
+		filled_length: int = 1536,
+		vocab_size: int = 32000,
+		eos_id: int = 2,
+		repetition_penalty: float = (1.0 / 0.85),
+		repeats: int = 20,
+		device: str = 'cpu',
+		seed: int = 0,
+):
+	generator = torch.Generator().manual_seed(seed)
+	tokens = torch.full((batch_size, context_length), PAD_ID, dtype=torch.long)
+	tokens[:, :filled_length] = torch.randint(0, vocab_size, (batch_size, filled_length), generator=generator)
+	tokens[:, -1] = eos_id
+	logits = torch.randn((batch_size, vocab_size), generator=generator).to(device)
+
+	expected = apply_repetition_penalty_loop(logits, tokens, repetition_penalty)
+	result = apply_repetition_penalty(logits, tokens, repetition_penalty)
+	if not torch.equal(expected, result):
+		raise ValueError(f"The vectorized repetition penalty differs from the loop, by up to {(expected - result).abs().max()}.")
+	print("The vectorized repetition penalty gives identical logits.")
+
+	loop_seconds = time_per_step(apply_repetition_penalty_loop, logits, tokens, repetition_penalty, repeats)
+	vectorized_seconds = time_per_step(apply_repetition_penalty, logits, tokens, repetition_penalty, repeats)
+	print(f"Loop:       {loop_seconds * 1000:.3f} ms per step")
+	print(f"Vectorized: {vectorized_seconds * 1000:.3f} ms per step ({loop_seconds / vectorized_seconds:.1f}x faster)")
+
+if __name__ == "__main__":
+	fire.Fire(main)
@@ -9,72 +9,149 @@ import fire
 import time
 import json
 import gc
+import shutil
+import warnings
 import pyarrow as pa
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from llama import ModelArgs, Transformer, Tokenizer, LLaMA
 
-
+DTYPES = {
+	'float32': torch.float32,
+	'bfloat16': torch.bfloat16,
+	'float16': torch.float16,
+}
+
+# Larger models come in several model parallel shards, which each have a slice of most tensors.
+# This is the dimension that each tensor is sliced along, like in merge-weights.py. Tensors that aren't listed are the same in every shard.
+SHARD_CONCAT_DIMS = {
+	'attention.wq.weight': 0,
+	'attention.wk.weight': 0,
+	'attention.wv.weight': 0,
+	'attention.wo.weight': 1,
+	'feed_forward.w1.weight': 0,
+	'feed_forward.w2.weight': 1,
+	'feed_forward.w3.weight': 0,
+	'tok_embeddings.weight': 1,
+	'output.weight': 0,
+}
+
+def get_shard_concat_dim(key):
+	return SHARD_CONCAT_DIMS.get(key.split('.', 2)[-1] if key.startswith('layers.') else key)
+
+def write_arrow_tensor(path, tensor):
+	with pa.output_stream(path) as f:
+		pa.ipc.write_tensor(pa.Tensor.from_numpy(tensor.numpy()), f)
+
+# Merges the slices of a tensor from every model parallel shard, and writes the whole tensor.
+def write_merged_arrow_tensor(path, key, shards):
+	concat_dim = get_shard_concat_dim(key)
+	if len(shards) == 1 or concat_dim is None:
+		tensor = shards[0][key]
+	else:
+		tensor = torch.cat([shard[key] for shard in shards], dim=concat_dim)
+	write_arrow_tensor(path, tensor)
+
+# Converts the checkpoint into a single directory of whole tensors, merging the model parallel shards if there are several,
+# so that loading it is only memory mapping, for any model size. Every tensor is merged and written in parallel.
+# The shards are memory mapped instead of read in full, so converting doesn't take the whole model in memory.
+# Note: the conversion happens in a temporary directory, so an interrupted conversion doesn't leave a partial arrow directory behind.
+def convert_checkpoints(checkpoints, arrow_dir, threads):
+	temporary_dir = arrow_dir.with_name(arrow_dir.name + '.tmp')
+	shutil.rmtree(temporary_dir, ignore_errors=True)
+	(temporary_dir / '00').mkdir(parents=True)
+	shards = []
+	for ckpt_file in checkpoints:
+		print(ckpt_file)
+		shards.append(torch.load(ckpt_file, map_location='cpu', mmap=True))
+	with ThreadPoolExecutor(max_workers=threads) as executor:
+		pending_writes = [
+			executor.submit(write_merged_arrow_tensor, temporary_dir / '00' / key, key, shards)
+			for key in shards[0]
+		]
+		for pending_write in pending_writes:
+			pending_write.result()
+	temporary_dir.rename(arrow_dir)
+
+# Note: the tensors are views of the memory mapped files, so nothing is read until it's used, and the pages can be shared between processes.
+# The memory maps stay open for as long as the tensors use them.
+def read_arrow_checkpoint(checkpoint_dir):
+	checkpoint = {}
+	with warnings.catch_warnings():
+		# The memory maps are read-only, which torch warns about. The parameters are never written to.
+		warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+		for seg in sorted(checkpoint_dir.glob("*")):
+			t = pa.ipc.read_tensor(pa.memory_map(str(seg))).to_numpy()
+			t = torch.from_numpy(t)
+			checkpoint[seg.parts[-1]] = t
+	return checkpoint
 
 def load(
 		ckpt_dir: str,
 		tokenizer_path: str,
 		max_seq_len: int,
 		max_batch_size: int,
+		device: str = 'cuda',
+		threads: int = None,
+		dtype: str = None,
 ) -> LLaMA:
 	start_time = time.time()
+	# Note: on the CPU, the matmuls are spread over this many threads, which defaults to all cores.
+	if device == 'cpu':
+		torch.set_num_threads(threads if threads is not None else os.cpu_count())
+	io_threads = threads if threads is not None else os.cpu_count()
 	arrow_dir = Path(ckpt_dir).expanduser() / 'arrow'
 
+	# Earlier conversions kept a directory per shard. Those have to be converted again, into a single merged one.
+	if arrow_dir.exists() and len(list(arrow_dir.glob("*"))) > 1:
+		print('Removing the arrow conversion with a directory per shard')
+		shutil.rmtree(arrow_dir)
 	if not arrow_dir.exists():
 		print('Converting checkpoints to arrow format')
-		checkpoints = sorted(Path(ckpt_dir).expanduser().glob("*.pth"))
-		for ckpt_file in checkpoints:
-			print(ckpt_file)
-			index = ckpt_file.parts[-1].split('.')[-2]
-
-			ckpt = torch.load(ckpt_file, map_location='cpu')
-			(arrow_dir / index).mkdir(parents=True, exist_ok=True)
-			for k, v in ckpt.items():
-				tens = pa.Tensor.from_numpy(v.numpy())
-				with pa.output_stream(arrow_dir / index / k) as f:
-					pa.ipc.write_tensor(tens, f)
-			ckpt = None
+		convert_checkpoints(sorted(Path(ckpt_dir).expanduser().glob("*.pth")), arrow_dir, io_threads)
 
 	with open(Path(ckpt_dir) / "params.json", "r") as f:
 		params = json.loads(f.read())
 
 	print("Loading checkpoint")
-	segments = sorted((arrow_dir / '00').glob("*"))
-
-	checkpoint = {}
-	files = []
-	for seg in segments:
-		f = pa.memory_map(str(seg))
-		files.append(f)
-		t = pa.ipc.read_tensor(f).to_numpy()
-		t = torch.from_numpy(t)
-		checkpoint[seg.parts[-1]] = t
-
+	checkpoint = read_arrow_checkpoint(arrow_dir / '00')
+
+	# Converting the checkpoint to another dtype would copy all of it, so on the GPU, the model runs in the dtype of the checkpoint by default.
+	# Note: this used to be bfloat16 on every device, and the released checkpoints are float16.
+	# On the CPU, it's still bfloat16 by default, because float16 matmuls are slow there (or not supported at all).
+	# That conversion does copy the checkpoint into memory, so pass dtype='float16' to keep it memory mapped instead.
+	checkpoint_dtype = checkpoint['tok_embeddings.weight'].dtype
+	if dtype is not None:
+		model_dtype = DTYPES[dtype]
+	elif device == 'cpu':
+		model_dtype = torch.bfloat16
+	else:
+		model_dtype = checkpoint_dtype
+		if model_dtype != torch.bfloat16:
+			warnings.warn(f"The model runs in the dtype of the checkpoint, {model_dtype}, instead of bfloat16 like it used to. Pass dtype='bfloat16' to convert it on load.")
 	# torch.set_default_tensor_type(torch.cuda.HalfTensor)
-	torch.set_default_tensor_type(torch.BFloat16Tensor)
+	# torch.set_default_tensor_type(torch.BFloat16Tensor)
 	# torch.set_default_tensor_type(torch.FloatTensor)
+	torch.set_default_dtype(model_dtype)
+	if model_dtype != checkpoint_dtype:
+		checkpoint = {key: value.to(model_dtype) if value.is_floating_point() else value for key, value in checkpoint.items()}
 
 	model_args: ModelArgs = ModelArgs(
-		max_seq_len=max_seq_len, max_batch_size=max_batch_size, **params
+		max_seq_len=max_seq_len, max_batch_size=max_batch_size, device=device, **params
 	)
 	print("Loading tokenizer")
 	tokenizer = Tokenizer(model_path=tokenizer_path)
 	model_args.vocab_size = tokenizer.n_words
 	print("Loading model")
+	# Note: the layers are created with skip_init(), so their parameters aren't touched before they're replaced by the checkpoint tensors.
 	model = Transformer(model_args)
-
-	checkpoints = sorted(Path(ckpt_dir).glob("*.pth"))
-	model.load_state_dict(torch.load(checkpoints[-1]), strict=False)
-
-	for f in files:
-		f.close()
-	files = None
+	model.load_state_dict(checkpoint, strict=False, assign=True)
+	# The norm and output layer are the only ones that are kept on the device, instead of being moved there per forward pass.
+	model.norm.to(device)
+	model.output.to(device)
+	checkpoint = None
 
 	generator = LLaMA(model, tokenizer)
 	print(f"Loaded in {time.time() - start_time:.2f} seconds")
@@ -83,7 +160,9 @@ def load(
 
 
 def cleanup():
-	print(torch.cuda.list_gpu_processes())
 	gc.collect()
+	if not torch.cuda.is_available():
+		return
+	print(torch.cuda.list_gpu_processes())
 	torch.cuda.empty_cache()
 	print(torch.cuda.list_gpu_processes())
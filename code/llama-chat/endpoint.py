@@ -1,12 +1,37 @@
 #!/usr/bin/env python3
 
 from flask import Flask, request, abort
+import base64
 import fire
 import json
+import pickle
+import threading
+import torch
 from common import load, cleanup
+from scheduling import ContinuousBatchScheduler, GenerationRequest
+from metrics import ServerMetrics, RequestLog, BATCH_SIZE_BUCKETS, TOKEN_COUNT_BUCKETS
+
+TOKENS_PER_SECOND_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0)
 
 app = Flask(__name__)
 
+METRICS = ServerMetrics()
+METRICS.instrument_flask_app(app)
+# Note: without continuous batching, there's no queue in front of the generator, so this counts the requests that are being handled at the same time instead.
+IN_FLIGHT_REQUESTS = 0
+IN_FLIGHT_LOCK = threading.Lock()
+
+log_request = RequestLog()
+
+# The compact internals modes return tensors, which are sent as base64 encoded pickles, like the BERT endpoint does with its logits.
+def encode_internals(internals):
+	if type(internals) != dict:
+		return internals
+	return {
+		key: base64.b64encode(pickle.dumps(value)).decode('utf-8') if isinstance(value, torch.Tensor) else value
+		for key, value in internals.items()
+	}
+
 @app.route("/generate", methods=['POST'])
 def generate(
 	temperature: float = 0.0,
@@ -14,6 +39,7 @@ def generate(
 	top_k: int = 40,
 	repetition_penalty: float = (1.0 / 0.85),  # 1.0 to disable repetition_penalty
 	sampler: str = 'top_p',  # top_p or top_k
+	internals_top_k: int = 10,
 ):
 	if not (
 		type(request.json) == dict
@@ -21,7 +47,7 @@ def generate(
 		and type(request.json['prompt']) == str
 	):
 		return {"error":"malformed request"}, 400
-	print('Got request', request.json)
+	log_request('Got request', request.json)
 
 	max_seq_len = request.json.get('max_seq_len', MAX_SEQ_LEN)
 
@@ -32,12 +58,58 @@ def generate(
 	top_k = request.json.get('top_k', top_k)
 	repetition_penalty = request.json.get('repetition_penalty', repetition_penalty)
 	sampler = request.json.get('sampler', sampler)
+	# One of 'full', 'top_k', 'tokens' or 'none', see INTERNALS_MODES in llama/generation.py.
+	internals = request.json.get('internals', INTERNALS)
+	internals_top_k = request.json.get('internals_top_k', internals_top_k)
+	internals_token_ids = request.json.get('internals_token_ids', None)
+
+	global IN_FLIGHT_REQUESTS
+	METRICS.observe('prompt_tokens_per_request', sum(len(GENERATOR.tokenizer.encode(prompt, bos=True, eos=False)) for prompt in prompts), buckets=TOKEN_COUNT_BUCKETS)
+	if SCHEDULER is not None:
+		return generate_scheduled(prompts[0], max_seq_len, temperature, top_p, top_k, repetition_penalty, sampler, internals)
+	METRICS.observe('batch_size', len(prompts), buckets=BATCH_SIZE_BUCKETS)
+	with IN_FLIGHT_LOCK:
+		IN_FLIGHT_REQUESTS += 1
+	try:
+		decoded, generation_internals, generation_stats = GENERATOR.generate_internals(
+			prompts, max_gen_len=max_seq_len, temperature=temperature, top_p=top_p, top_k=top_k, repetition_penalty=repetition_penalty, sampler=sampler, verbose=log_request.verbose,
+			internals=internals, internals_top_k=internals_top_k, internals_token_ids=internals_token_ids,
+		)
+	except ValueError as e:
+		return {"error": str(e)}, 400
+	finally:
+		with IN_FLIGHT_LOCK:
+			IN_FLIGHT_REQUESTS -= 1
+	# Note: each step is one forward pass, so this is the number of generated tokens.
+	METRICS.observe('generated_tokens_per_request', generation_stats['steps'], buckets=TOKEN_COUNT_BUCKETS)
+	METRICS.observe('tokens_per_second', generation_stats['tokens_per_second'] or 0.0, buckets=TOKENS_PER_SECOND_BUCKETS)
+	log_request('Returning result', decoded)
+	return {'output': decoded, 'internals': encode_internals(generation_internals)}
+
+# With continuous batching, the request is generated together with the other requests that are in progress.
+def generate_scheduled(prompt, max_seq_len, temperature, top_p, top_k, repetition_penalty, sampler, internals):
+	if internals != 'none':
+		return {"error": "Internals aren't recorded with continuous batching, so 'internals' has to be 'none'."}, 400
+	try:
+		decoded, generation_stats = SCHEDULER(GenerationRequest(
+			prompt=prompt,
+			max_gen_len=max_seq_len,
+			temperature=temperature,
+			top_p=top_p,
+			top_k=top_k,
+			repetition_penalty=repetition_penalty,
+			sampler=sampler,
+		))
+	except ValueError as e:
+		return {"error": str(e)}, 400
+	METRICS.observe('generated_tokens_per_request', generation_stats['steps'], buckets=TOKEN_COUNT_BUCKETS)
+	METRICS.observe('tokens_per_second', generation_stats['tokens_per_second'] or 0.0, buckets=TOKENS_PER_SECOND_BUCKETS)
+	log_request('Returning result', [decoded])
+	return {'output': [decoded], 'internals': None}
 
-	results = GENERATOR.generate_internals(
-		prompts, max_gen_len=max_seq_len, temperature=temperature, top_p=top_p, top_k=top_k, repetition_penalty=repetition_penalty, sampler=sampler
-	)
-	print('Returning result', results[0])
-	return {'output': results[0], 'internals': results[1]}
+@app.route("/metrics", methods=['GET'])
+def metrics():
+	return METRICS.to_dict()
 
 def main(
 		port: int,
@@ -45,10 +117,35 @@ def main(
 		tokenizer_path: str,
 		max_seq_len: int = 2048,
 		max_batch_size: int = 1,
+		quiet: bool = False,
+		internals: str = None,
+		device: str = 'cuda',
+		threads: int = None,
+		dtype: str = None,
+		continuous_batching: bool = False,
 ):
-	global GENERATOR, MAX_SEQ_LEN
+	global GENERATOR, MAX_SEQ_LEN, INTERNALS, SCHEDULER
+	log_request.verbose = not quiet
+	# The internals mode for requests that don't ask for one. The 'full' mode makes very large responses for long generations.
+	# Continuous batching doesn't record internals, so it defaults to 'none'.
+	INTERNALS = internals if internals is not None else ('none' if continuous_batching else 'full')
 	MAX_SEQ_LEN = max_seq_len
-	GENERATOR = load(ckpt_dir, tokenizer_path, MAX_SEQ_LEN, max_batch_size)
+	# Note: without --dtype, the model runs in bfloat16 on the CPU, and in the dtype of the checkpoint (float16 for the released weights) on the GPU.
+	# It used to be bfloat16 on the GPU too; pass --dtype=bfloat16 for that.
+	GENERATOR = load(ckpt_dir, tokenizer_path, MAX_SEQ_LEN, max_batch_size, device=device, threads=threads, dtype=dtype)
+	# Note: with continuous batching, up to max_batch_size requests are generated at the same time.
+	SCHEDULER = ContinuousBatchScheduler(GENERATOR, max_batch_size, MAX_SEQ_LEN) if continuous_batching else None
+	if SCHEDULER is not None:
+		METRICS.register_gauge('queue_depth', SCHEDULER.queue_depth)
+		METRICS.register_gauge('active_sequences', SCHEDULER.active_count)
+		METRICS.register_gauge('scheduler', SCHEDULER.get_stats)
+	else:
+		METRICS.register_gauge('queue_depth', lambda: IN_FLIGHT_REQUESTS)
+	METRICS.register_gauge('loaded_model_bytes', lambda: sum(
+		tensor.numel() * tensor.element_size()
+		for tensor in list(GENERATOR.model.parameters()) + list(GENERATOR.model.buffers())
+	))
+	METRICS.register_gauge('kv_cache_bytes', GENERATOR.model.kv_cache_bytes)
 
 	app.run(port=port)
 
@@ -9,15 +9,22 @@
 # taken here
 # https://github.com/shawwn/llama/commit/40d99d329a5e38d85904d3a6519c54e6dd6ee9e1
 
-from typing import List
+from typing import List, Optional
 
+import time
 import torch
-import traceback
 
 from llama.tokenizer import Tokenizer
 from llama.model import Transformer
 from tqdm import trange
 
+# What generate_internals() records of each step:
+# - 'full': the logits of the whole vocab, and their numeric contributions, as lists. This is large: two vocab sized lists per step.
+# - 'top_k': the internals_top_k highest logits and their token ids.
+# - 'tokens': the logits of the internals_token_ids only.
+# - 'none': nothing.
+INTERNALS_MODES = ('full', 'top_k', 'tokens', 'none')
+
 
 class LLaMA:
     def __init__(self, model: Transformer, tokenizer: Tokenizer):
@@ -33,12 +40,20 @@ class LLaMA:
             top_k: int = 40,
             repetition_penalty: float = (1.0 / 0.85),
             sampler: str = 'top_k',
-    ) -> tuple[List[str],]:
+            verbose: bool = False,
+            internals: str = 'full',
+            internals_top_k: int = 10,
+            internals_token_ids: Optional[List[int]] = None,
+    ) -> tuple[List[str], Optional[dict], dict]:
         bsz = len(prompts)
         params = self.model.params
         assert bsz <= params.max_batch_size, (bsz, params.max_batch_size)
+        if internals not in INTERNALS_MODES:
+            raise ValueError(f"Unknown internals mode '{internals}'. Expected one of {INTERNALS_MODES}.")
+        if internals == 'tokens' and not internals_token_ids:
+            raise ValueError("The 'tokens' internals mode needs internals_token_ids.")
 
-        count_newlines = prompts[0].count("\n")
+        prompt_newline_counts = [prompt.count("\n") for prompt in prompts]
 
         prompt_tokens = [self.tokenizer.encode(x, bos=True, eos=False) for x in prompts]
 
@@ -55,26 +70,35 @@ class LLaMA:
         start_pos = min_prompt_size
         prev_pos = 0
         decoded = [None] * bsz
+        decoders = [IncrementalDecoder(self.tokenizer) for _ in range(bsz)]
+        finished = [False] * bsz
+        newline_counts = [0] * bsz
 
         generation_intermediates_values = []
+        # Note: except in the 'full' mode, the recorded internals stay on the device of the logits until the end, as one tensor per step.
+        recorded_logits = []
+        recorded_token_ids = []
+        recorded_numeric_contributions = []
+        recorded_next_tokens = []
+        recorded_decoded_lengths = []
 
-        for cur_pos in trange(start_pos, total_len, desc="forward"):
-            logits = self.model.forward(tokens[:, prev_pos:cur_pos], prev_pos)
+        steps = 0
+        start_time = time.perf_counter()
+        for cur_pos in trange(start_pos, total_len, desc="forward", disable=not verbose):
+            logits = self.model.forward(tokens[:, prev_pos:cur_pos], prev_pos, verbose=verbose)
 
             # repetition penalty from CTRL paper (https://arxiv.org/abs/1909.05858)
             if repetition_penalty != 1.0:
-                logits_new = logits.clone()
-                batch_size = len(tokens)
-                for i in range(batch_size):
-                    for token in set(tokens[i].tolist()):
-                        # if score < 0 then repetition penalty has to multiplied to reduce the previous token probability
-                        if logits[i, token] < 0:
-                            logits_new[i, token] = logits[i, token] * repetition_penalty
-                        else:
-                            logits_new[i, token] = logits[i, token] / repetition_penalty
-                logits = logits_new
-
-            intermediate_logits = logits.cpu().tolist()
+                logits = apply_repetition_penalty(logits, tokens, repetition_penalty)
+
+            if internals == 'full':
+                intermediate_logits = logits.cpu().tolist()
+            elif internals == 'top_k':
+                top_logits, top_token_ids = torch.topk(logits, internals_top_k, dim=-1)
+                recorded_logits.append(top_logits)
+                recorded_token_ids.append(top_token_ids)
+            elif internals == 'tokens':
+                recorded_logits.append(logits[:, internals_token_ids])
 
             # TODO: remove this duplicate functionality from sample_top_p()
             # import pdb
@@ -84,78 +108,159 @@ class LLaMA:
             # numeric_tokens = torch.tensor([[29900, 29906, 29941, 29946, 29945, 29953, 29955, 29947, 29929]], dtype=torch.int64).cuda()
             # numeric_token_values = torch.tensor([[0,2,3,4,5,6,7,8,9]], dtype=torch.float).cuda()
             # numeric_token_values = torch.tensor([[-5,-3,2,-1,0,1,2,3,4]], dtype=torch.float).cuda()
-            numeric_tokens = torch.tensor([[4482, 18350, 1880]], dtype=torch.int64).cuda()
-            numeric_token_values = torch.tensor([[5,6,7]], dtype=torch.float).cuda()
-            numeric_mask = torch.ones_like(logits, dtype=torch.bool).scatter_(-1, numeric_tokens, False)
-            # logits[numeric_mask] = -float('inf')
-            logits_numeric_factor = torch.zeros_like(logits, dtype=torch.float).scatter_(-1, numeric_tokens, False)
-            # logits_numeric_factor.index_copy_(-1, numeric_tokens, numeric_token_values)
-            logits_numeric_factor.index_copy_(-1, numeric_tokens[0], numeric_token_values)
-            logits_numeric_contributions = logits * logits_numeric_factor
-            intermediate_logits_numeric_contributions = logits_numeric_contributions.cpu().tolist()
-            print(logits_numeric_contributions.mean())
-            for value, token in enumerate([4482, 18350, 1880]):
-                print(f"value\n{logits[0][token]}")
-            if temperature > 0:
-                raise ValueError("The code isn't supposed to take this path.")
-                probs = torch.softmax(logits / temperature, dim=-1)
-                if sampler == 'top_k':
-                    next_token = sample_top_k(probs, top_p=top_p, top_k=top_k)
-                else:
-                    next_token = sample_top_p(probs, top_p)
-            else:
-                # print(torch.max(logits, dim=-1))
-                # TODO: verify if the value is above 0.
-                next_token = torch.argmax(logits, dim=-1)
+            numeric_tokens = torch.tensor([[4482, 18350, 1880]], dtype=torch.int64, device=logits.device)
+            numeric_token_values = torch.tensor([[5,6,7]], dtype=torch.float, device=logits.device)
+            if internals == 'full' or verbose:
+                numeric_mask = torch.ones_like(logits, dtype=torch.bool).scatter_(-1, numeric_tokens, False)
+                # logits[numeric_mask] = -float('inf')
+                logits_numeric_factor = torch.zeros_like(logits, dtype=torch.float).scatter_(-1, numeric_tokens, False)
+                # logits_numeric_factor.index_copy_(-1, numeric_tokens, numeric_token_values)
+                logits_numeric_factor.index_copy_(-1, numeric_tokens[0], numeric_token_values)
+                logits_numeric_contributions = logits * logits_numeric_factor
+            if internals == 'full':
+                intermediate_logits_numeric_contributions = logits_numeric_contributions.cpu().tolist()
+            elif internals != 'none':
+                # The numeric contributions are zero everywhere except at the numeric tokens, so only those are kept.
+                recorded_numeric_contributions.append(logits[:, numeric_tokens[0]] * numeric_token_values)
+            if verbose:
+                print(logits_numeric_contributions.mean())
+                for value, token in enumerate([4482, 18350, 1880]):
+                    print(f"value\n{logits[0][token]}")
+            next_token = sample_next_token(logits, temperature, top_p, top_k, sampler)
             next_token = next_token.reshape(-1).cpu()
-            intermediate_next_token = next_token.tolist()
+            if internals == 'full':
+                intermediate_next_token = next_token.tolist()
+            elif internals != 'none':
+                recorded_next_tokens.append(next_token)
             # only replace token if prompt has already been generated
             next_token = torch.where(
                 input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
             )
             tokens[:, cur_pos] = next_token
-            print(tokens)
+            if verbose:
+                print(tokens[:, cur_pos])
             prev_pos = cur_pos
 
-            print("-" * 30)
-            for i, t in enumerate(tokens.tolist()):
-                # i = cur_pos
-                # t = next_token
+            if verbose:
+                print("-" * 30)
+            # Only the tokens that were added since the last step are decoded.
+            # Note: the decoded text stops right before cur_pos, so it doesn't have the token that was just generated yet.
+            for i in range(bsz):
                 # cut to max gen len
-                # t = t[: len(pr-ompt_tokens[i]) + max_gen_len]
-                t = t[: min(cur_pos, len(prompt_tokens[i]) + max_gen_len)]
+                end = min(cur_pos, len(prompt_tokens[i]) + max_gen_len)
+                if finished[i] or end <= len(decoders[i].tokens):
+                    continue
+                new_tokens = tokens[i, len(decoders[i].tokens):end].tolist()
                 # cut to eos tok if any
-                try:
-                    t = t[: t.index(self.tokenizer.eos_id)]
-                except ValueError:
-                    pass  # traceback.print_exc()
-                try:
-                    d = self.tokenizer.decode(t)
-                    print(d)
-                    decoded[i] = d
-                    print(decoded)
-                    
-                    result_count_newlines = d.count("\n")
-
-                except IndexError:
-                    traceback.print_exc()
-                    print(t)
-            generation_intermediates_values.append({
-                'intermediate_logits': intermediate_logits,
-                'intermediate_logits_numeric_contributions': intermediate_logits_numeric_contributions,
-                'next_token': intermediate_next_token,
-                'decoded': decoded.copy(),
-            })
-            print("-" * 30)
-            if result_count_newlines > count_newlines:
-                return decoded, generation_intermediates_values
-        return decoded, generation_intermediates_values
+                if self.tokenizer.eos_id in new_tokens:
+                    new_tokens = new_tokens[: new_tokens.index(self.tokenizer.eos_id)]
+                    finished[i] = True
+                new_text = decoders[i].add(new_tokens)
+                newline_counts[i] += new_text.count("\n")
+                decoded[i] = decoders[i].text
+                if verbose:
+                    print(repr(new_text))
+            steps += 1
+            if internals == 'full':
+                generation_intermediates_values.append({
+                    'intermediate_logits': intermediate_logits,
+                    'intermediate_logits_numeric_contributions': intermediate_logits_numeric_contributions,
+                    'next_token': intermediate_next_token,
+                    'decoded': decoded.copy(),
+                })
+            elif internals != 'none':
+                # The decoded text only grows, so its length at each step is enough to recover it from the final text.
+                recorded_decoded_lengths.append([len(decoded_text) if decoded_text is not None else None for decoded_text in decoded])
+            if verbose:
+                print("-" * 30)
+            # Stop once every sequence has started a new line.
+            if all(newline_count > prompt_newline_count for newline_count, prompt_newline_count in zip(newline_counts, prompt_newline_counts)):
+                break
+        seconds = time.perf_counter() - start_time
+
+        # Note: these are returned rather than kept on the generator, because concurrent calls would overwrite each other's.
+        generation_stats = {
+            'steps': steps,
+            'seconds': seconds,
+            'tokens_per_second': steps * bsz / seconds if seconds > 0 else None,
+        }
+        if verbose:
+            print(f"Generated {steps} steps for {bsz} sequences in {seconds:.2f} seconds ({generation_stats['tokens_per_second']:.2f} tokens/s)")
+
+        # The incremental decoding can hold back an incomplete character at the end, so the final texts are decoded in full, once.
+        decoded = [self.tokenizer.decode(decoder.tokens) if decoded_text is not None else None for decoder, decoded_text in zip(decoders, decoded)]
+        if internals == 'none':
+            generation_intermediates_values = None
+        elif internals != 'full':
+            # Note: the tensors are laid out as [batch, step, ...].
+            generation_intermediates_values = {
+                'mode': internals,
+                'next_token': torch.stack(recorded_next_tokens, dim=1).cpu() if steps > 0 else None,
+                'decoded_lengths': [list(row_lengths) for row_lengths in zip(*recorded_decoded_lengths)],
+                'logits': torch.stack(recorded_logits, dim=1).cpu() if steps > 0 else None,
+                'token_ids': torch.stack(recorded_token_ids, dim=1).cpu() if internals == 'top_k' and steps > 0 else internals_token_ids,
+                'numeric_contributions': torch.stack(recorded_numeric_contributions, dim=1).cpu() if steps > 0 else None,
+            }
+        return decoded, generation_intermediates_values, generation_stats
 
     # This is the function signature that a lot of old/upstream code depended on
     def generate(self, *args, **kwargs):
         return self.generate_internals(*args, **kwargs)[0]
 
 
+# Decodes a growing list of tokens, while only decoding the last few tokens whenever some are added.
+# SentencePiece drops the space at the start of a text, and a character can be split over several byte tokens.
+# So the added text is the difference between decoding the recent tokens with and without the new ones,
+# and it's held back while it ends in an incomplete character.
+class IncrementalDecoder:
+    def __init__(self, tokenizer: Tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens = []
+        self.text = ''
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    # Adds the tokens, and returns the text that was added because of them.
+    def add(self, new_tokens: List[int]) -> str:
+        self.tokens += new_tokens
+        prefix_text = self.tokenizer.decode(self.tokens[self._prefix_offset:self._read_offset])
+        new_text = self.tokenizer.decode(self.tokens[self._prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith('\ufffd'):
+            return ''
+        new_text = new_text[len(prefix_text):]
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self.tokens)
+        self.text += new_text
+        return new_text
+
+
+# Penalizes the logits of every token that occurs anywhere in `tokens`, row by row, all at once.
+# Note: this penalizes the same tokens as the loop over set(tokens[i].tolist()) that it replaces, including the padding
+# (pad_id is -1, so that indexes the last vocab entry) and the positions that haven't been generated yet.
+def apply_repetition_penalty(logits: torch.Tensor, tokens: torch.Tensor, repetition_penalty: float) -> torch.Tensor:
+    token_indices = tokens.to(logits.device)
+    token_indices = torch.where(token_indices < 0, token_indices + logits.shape[-1], token_indices)
+    scores = torch.gather(logits, -1, token_indices)
+    # if score < 0 then repetition penalty has to multiplied to reduce the previous token probability
+    scores = torch.where(scores < 0, scores * repetition_penalty, scores / repetition_penalty)
+    # Note: tokens that occur more than once are scattered several times, but always with the same value.
+    return logits.scatter(-1, token_indices, scores)
+
+
+def sample_next_token(logits: torch.Tensor, temperature: float, top_p: float, top_k: int, sampler: str) -> torch.Tensor:
+    if temperature > 0:
+        raise ValueError("The code isn't supposed to take this path.")
+        probs = torch.softmax(logits / temperature, dim=-1)
+        if sampler == 'top_k':
+            return sample_top_k(probs, top_p=top_p, top_k=top_k)
+        else:
+            return sample_top_p(probs, top_p)
+    else:
+        # print(torch.max(logits, dim=-1))
+        # TODO: verify if the value is above 0.
+        return torch.argmax(logits, dim=-1)
+
+
 # default sampler
 def sample_top_p(probs, p):
     probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
@@ -163,7 +268,7 @@ def sample_top_p(probs, p):
     mask = probs_sum - probs_sort > p
     # Note: this list of tokens excludes token "29871", which marks a separation at the start of a numeric sequence of tokens.
     # For example, a space between the preceding word and the following number.
-    numeric_tokens = torch.tensor([29900, 29896, 29906, 29941, 29946, 29945, 29953, 29955, 29947, 29929], dtype=torch.int64).cuda()
+    numeric_tokens = torch.tensor([29900, 29896, 29906, 29941, 29946, 29945, 29953, 29955, 29947, 29929], dtype=torch.int64, device=probs.device)
     numeric_mask = ~torch.isin(probs_idx, numeric_tokens)
     probs_sort[numeric_mask] = 0.0
     # probs_sort[mask] = 0.0
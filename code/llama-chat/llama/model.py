@@ -15,6 +15,9 @@ from torch.nn.utils import skip_init
 
 from tqdm import tqdm
 
+# The KV caches grow by this many positions at a time, up to max_seq_len.
+KV_CACHE_BLOCK_SIZE = 256
+
 @dataclass
 class ModelArgs:
     dim: int = 512
@@ -27,6 +30,10 @@ class ModelArgs:
     max_batch_size: int = 32
     max_seq_len: int = 1024
 
+    # With 'cuda', the layers stay in CPU memory, and the parameters of each layer are moved to the GPU only while it runs.
+    # With 'cpu', everything stays on the CPU.
+    device: str = 'cuda'
+
 
 class RMSNorm(torch.nn.Module):
     def __init__(self, dim: int, eps: float = 1e-6):
@@ -53,6 +60,10 @@ def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
 def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     ndim = x.ndim
     assert 0 <= 1 < ndim
+    if freqs_cis.ndim == 3:
+        # Each sequence has its own positions: (bsz, seqlen, head_dim // 2)
+        assert freqs_cis.shape == (x.shape[0], x.shape[1], x.shape[-1])
+        return freqs_cis[:, :, None, :]
     assert freqs_cis.shape == (x.shape[1], x.shape[-1])
     shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
     return freqs_cis.view(*shape)
@@ -99,14 +110,30 @@ class Attention(nn.Module):
             bias=False,
         )
 
-        self.cache_k = torch.zeros(
-            (args.max_batch_size, args.max_seq_len, self.n_local_heads, self.head_dim)
-        ).cuda()
-        self.cache_v = torch.zeros(
-            (args.max_batch_size, args.max_seq_len, self.n_local_heads, self.head_dim)
-        ).cuda()
-
-    def forward(self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor]):
+        # Note: the caches are only allocated once they're used, in the dtype and on the device of the keys and values,
+        # and they grow with the batch size and sequence length, instead of starting at max_batch_size and max_seq_len.
+        self.max_seq_len = args.max_seq_len
+        self.cache_k = None
+        self.cache_v = None
+
+    def reserve_cache(self, bsz: int, end_pos: int, like: torch.Tensor):
+        if self.cache_k is not None and self.cache_k.shape[0] >= bsz and self.cache_k.shape[1] >= end_pos:
+            return
+        assert end_pos <= self.max_seq_len, (end_pos, self.max_seq_len)
+        cache_bsz = max(bsz, self.cache_k.shape[0] if self.cache_k is not None else 0)
+        cache_len = min(self.max_seq_len, -(-end_pos // KV_CACHE_BLOCK_SIZE) * KV_CACHE_BLOCK_SIZE)
+        cache_k = torch.zeros((cache_bsz, cache_len, self.n_local_heads, self.head_dim), dtype=like.dtype, device=like.device)
+        cache_v = torch.zeros_like(cache_k)
+        if self.cache_k is not None:
+            old_bsz, old_len = self.cache_k.shape[:2]
+            cache_k[:old_bsz, :old_len] = self.cache_k
+            cache_v[:old_bsz, :old_len] = self.cache_v
+        self.cache_k = cache_k
+        self.cache_v = cache_v
+
+    # With slots, each sequence uses its own row of the cache, and is at its own position:
+    # start_pos is then a tensor with the start position of each sequence, and the mask has to be given per sequence.
+    def forward(self, x: torch.Tensor, start_pos, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor], slots: Optional[torch.Tensor] = None):
         bsz, seqlen, _ = x.shape
         xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
 
@@ -116,14 +143,39 @@ class Attention(nn.Module):
 
         xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
 
-        self.cache_k = self.cache_k.to(xq)
-        self.cache_v = self.cache_v.to(xq)
-
-        self.cache_k[:bsz, start_pos : start_pos + seqlen] = xk
-        self.cache_v[:bsz, start_pos : start_pos + seqlen] = xv
-
-        keys = self.cache_k[:bsz, : start_pos + seqlen]
-        values = self.cache_v[:bsz, : start_pos + seqlen]
+        if slots is None:
+            self.reserve_cache(bsz, start_pos + seqlen, xk)
+
+            self.cache_k[:bsz, start_pos : start_pos + seqlen] = xk
+            self.cache_v[:bsz, start_pos : start_pos + seqlen] = xv
+
+            keys = self.cache_k[:bsz, : start_pos + seqlen]
+            values = self.cache_v[:bsz, : start_pos + seqlen]
+        else:
+            end_pos = int(start_pos.max()) + seqlen
+            first_slot = int(slots.min())
+            row_count = int(slots.max()) + 1 - first_slot
+            self.reserve_cache(first_slot + row_count, end_pos, xk)
+
+            positions = start_pos[:, None] + torch.arange(seqlen, device=start_pos.device)
+            self.cache_k[slots[:, None], positions] = xk
+            self.cache_v[slots[:, None], positions] = xv
+
+            # Note: gathering the rows of the slots would copy the whole history of every sequence, in every layer, on every step.
+            #       So the attention runs on a view of the cache rows from the lowest to the highest slot instead.
+            #       Each query goes in the row of its slot, and the rows between the slots get zero queries, whose outputs are dropped.
+            keys = self.cache_k[first_slot : first_slot + row_count, :end_pos]
+            values = self.cache_v[first_slot : first_slot + row_count, :end_pos]
+            rows = slots - first_slot
+            if row_count == bsz and bool((rows == torch.arange(bsz, device=rows.device)).all()):
+                rows = None
+            else:
+                xq_rows = xq.new_zeros((row_count,) + xq.shape[1:])
+                xq_rows[rows] = xq
+                xq = xq_rows
+                mask_rows = mask.new_zeros((row_count,) + mask.shape[1:])
+                mask_rows[rows] = mask
+                mask = mask_rows
 
         xq = xq.transpose(1, 2)
         keys = keys.transpose(1, 2)
@@ -133,6 +185,8 @@ class Attention(nn.Module):
             scores = scores + mask  # (bs, n_local_heads, slen, cache_len + slen)
         scores = F.softmax(scores.float(), dim=-1).type_as(xq)
         output = torch.matmul(scores, values)  # (bs, n_local_heads, slen, head_dim)
+        if slots is not None and rows is not None:
+            output = output[rows]
         output = output.transpose(
             1, 2
         ).contiguous().view(bsz, seqlen, -1)
@@ -185,20 +239,20 @@ class TransformerBlock(nn.Module):
         self.attention_norm = RMSNorm(args.dim, eps=args.norm_eps)
         self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps)
 
-    def forward(self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor]):
-        h = x + self.attention.forward(self.attention_norm(x), start_pos, freqs_cis, mask)
+    def forward(self, x: torch.Tensor, start_pos, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor], slots: Optional[torch.Tensor] = None):
+        h = x + self.attention.forward(self.attention_norm(x), start_pos, freqs_cis, mask, slots)
         out = h + self.feed_forward.forward(self.ffn_norm(h))
         return out
 
 # https://github.com/gmorenz/llama/commit/4daf7f1a2f2bb22208b5d464bc2a18511d54408d
-def move_parameters_to_gpu(module):
+def move_parameters_to_gpu(module, device="cuda"):
     if not hasattr(module, "saved"):
         module.saved = module._parameters.copy()
     for k, param in module.saved.items():
         if param is not None:
-            module._parameters[k] = param.to("cuda", non_blocking=True)
+            module._parameters[k] = param.to(device, non_blocking=True)
     for child in module.children():
-        move_parameters_to_gpu(child)
+        move_parameters_to_gpu(child, device)
 
 def move_parameters_to_cpu(module):
     for k, param in module.saved.items():
@@ -226,42 +280,70 @@ class Transformer(nn.Module):
 
         self.layer_locations = [None] * len(self.layers)
 
-        self.norm = RMSNorm(params.dim, eps=params.norm_eps).cuda()
+        self.norm = RMSNorm(params.dim, eps=params.norm_eps).to(params.device)
         self.output = skip_init(nn.Linear,
             params.dim,
             params.vocab_size,
             bias=False,
-        ).cuda()
+        ).to(params.device)
 
         self.freqs_cis = precompute_freqs_cis(
             self.params.dim // self.params.n_heads, self.params.max_seq_len * 2
-        ).cuda()
+        ).to(params.device)
+
+    def kv_cache_bytes(self):
+        return sum(
+            cache.numel() * cache.element_size()
+            for layer in self.layers
+            for cache in (layer.attention.cache_k, layer.attention.cache_v)
+            if cache is not None
+        )
+
+    # Frees the KV caches, which otherwise keep the size of the longest generation so far.
+    def clear_kv_cache(self):
+        for layer in self.layers:
+            layer.attention.cache_k = None
+            layer.attention.cache_v = None
 
+    # Without slots, the sequences are in rows 0 to bsz of the KV caches, and all of them start at start_pos.
+    # With slots, sequence i is in row slots[i] of the KV caches, and starts at start_pos[i], so sequences at different
+    # positions can share a forward pass. The logits are those of the last token of each sequence, so they should all have seqlen tokens.
     @torch.inference_mode()
-    def forward(self, tokens: torch.Tensor, start_pos: int):
-        use_gpu = True  # start_pos == 0
+    def forward(self, tokens: torch.Tensor, start_pos, verbose: bool = False, slots: Optional[torch.Tensor] = None):
+        # Note: on the CPU, the parameters are used where they are, so there's nothing to move around.
+        use_gpu = self.params.device != 'cpu'  # start_pos == 0
 
         _bsz, seqlen = tokens.shape
         h = self.tok_embeddings(tokens)
         self.freqs_cis = self.freqs_cis
-        freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
         if use_gpu:
-            h = h.cuda()
+            h = h.to(self.params.device)
 
         mask = None
-        if seqlen > 1:
-            mask = torch.full(
-                (1, 1, seqlen, seqlen), float("-inf"), device=tokens.device
-            )
-            mask = torch.triu(mask, diagonal=start_pos + 1).type_as(h)
+        if slots is not None:
+            slots = slots.to(self.freqs_cis.device)
+            start_pos = start_pos.to(self.freqs_cis.device)
+            positions = start_pos[:, None] + torch.arange(seqlen, device=start_pos.device)
+            freqs_cis = self.freqs_cis[positions]
+            # Each token sees the positions of its own sequence up to itself.
+            key_positions = torch.arange(int(start_pos.max()) + seqlen, device=start_pos.device)
+            mask = torch.zeros((_bsz, 1, seqlen, len(key_positions)), device=start_pos.device)
+            mask = mask.masked_fill(key_positions[None, None, None, :] > positions[:, None, :, None], float("-inf")).type_as(h)
+        else:
+            freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
+            if seqlen > 1:
+                mask = torch.full(
+                    (1, 1, seqlen, seqlen), float("-inf"), device=tokens.device
+                )
+                mask = torch.triu(mask, diagonal=start_pos + 1).type_as(h)
 
         if use_gpu and mask is not None:
-            mask = mask.cuda()
+            mask = mask.to(self.params.device)
 
-        for layer in tqdm(self.layers, desc="flayers", leave=True):
+        for layer in tqdm(self.layers, desc="flayers", leave=True, disable=not verbose):
             if use_gpu:
-                move_parameters_to_gpu(layer)
-            h = layer(h, start_pos, freqs_cis, mask)
+                move_parameters_to_gpu(layer, self.params.device)
+            h = layer(h, start_pos, freqs_cis, mask, slots)
             if use_gpu:
                 move_parameters_to_cpu(layer)
 
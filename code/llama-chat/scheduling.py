@@ -0,0 +1,238 @@
+import threading
+import time
+import torch
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from llama.generation import IncrementalDecoder, apply_repetition_penalty, sample_next_token
+
+GenerationRequest = namedtuple('GenerationRequest', [
+	'prompt',
+	'max_gen_len',
+	'temperature',
+	'top_p',
+	'top_k',
+	'repetition_penalty',
+	'sampler',
+])
+
+# The state of a request that is being generated, in its own row (slot) of the KV caches.
+class ActiveSequence:
+	def __init__(self, request, future, enqueued_at, slot, prompt_tokens, total_len, tokenizer):
+		self.request = request
+		self.future = future
+		self.enqueued_at = enqueued_at
+		self.started_at = time.monotonic()
+		self.slot = slot
+		self.tokens = prompt_tokens
+		self.total_len = total_len
+		self.steps = 0
+		self.decoder = IncrementalDecoder(tokenizer)
+		self.newline_count = self.decoder.add(prompt_tokens).count("\n")
+		self.prompt_newline_count = request.prompt.count("\n")
+
+
+# Generates the requests of concurrent callers together, with continuous batching: every step is one forward pass for all
+# sequences that are being generated, each at its own position. New requests are admitted in between steps, as soon as
+# there's a free slot, and sequences are retired as soon as they're done, instead of waiting for the whole batch.
+# Every request keeps its own sampling parameters and lengths.
+# The result of each request is the same as what LLaMA.generate_internals() returns for it alone, without internals:
+# the decoded text, up to and including the first new line that was generated, and the generation stats.
+# Note: this runs the model from a single worker thread, so nothing else should use the model at the same time.
+class ContinuousBatchScheduler:
+	def __init__(self, generator, max_batch_size, max_seq_len, stats_window=10000):
+		if max_batch_size < 1:
+			raise ValueError(f"Expected max_batch_size to be at least 1, but got {max_batch_size}.")
+		self._generator = generator
+		self.max_batch_size = max_batch_size
+		self.max_seq_len = max_seq_len
+
+		self._queue = deque()
+		self._condition = threading.Condition()
+		self._active = []
+		self._free_slots = list(range(max_batch_size))
+
+		# Note: the latencies and batch sizes only cover the last stats_window requests and steps.
+		self._latencies = deque(maxlen=stats_window)
+		self._batch_sizes = deque(maxlen=stats_window)
+		self._completed_count = 0
+		self._generated_tokens = 0
+		self._busy_seconds = 0.0
+		self._started_at = time.monotonic()
+
+		self._worker = threading.Thread(target=self._run, daemon=True)
+		self._worker.start()
+
+	def submit(self, request) -> Future:
+		future = Future()
+		with self._condition:
+			self._queue.append((request, future, time.monotonic()))
+			self._condition.notify()
+		return future
+
+	def __call__(self, request):
+		return self.submit(request).result()
+
+	def queue_depth(self):
+		with self._condition:
+			return len(self._queue)
+
+	def active_count(self):
+		with self._condition:
+			return len(self._active)
+
+	# Takes as many queued requests as there are free slots. This only blocks when nothing is being generated.
+	def _take_requests(self):
+		with self._condition:
+			while len(self._queue) == 0 and len(self._active) == 0:
+				self._condition.wait()
+			return [self._queue.popleft() for _ in range(min(len(self._queue), len(self._free_slots)))]
+
+	def _run(self):
+		while True:
+			new_requests = deque(self._take_requests())
+			start_time = time.perf_counter()
+			# Note: anything that goes wrong outside of a single sequence fails all active sequences, because any of them could be affected.
+			#       It mustn't end this thread, because then every later request would wait forever.
+			try:
+				while len(new_requests) > 0:
+					self._admit(*new_requests.popleft())
+				if len(self._active) > 0:
+					self._step()
+			except Exception as e:
+				for sequence in list(self._active):
+					self._retire(sequence, e)
+				# The requests that weren't admitted yet aren't affected, so they go back to the front of the queue.
+				with self._condition:
+					self._queue.extendleft(reversed(new_requests))
+			with self._condition:
+				self._busy_seconds += time.perf_counter() - start_time
+
+	# Runs the prompt of a new request in its own forward pass, which gives the logits for its first generated token.
+	def _admit(self, request, future, enqueued_at):
+		tokenizer = self._generator.tokenizer
+		sequence = None
+		try:
+			prompt_tokens = tokenizer.encode(request.prompt, bos=True, eos=False)
+			# Note: like in generate_internals(), the last position of the row is taken by the eos.
+			total_len = min(self.max_seq_len, request.max_gen_len + len(prompt_tokens))
+			if len(prompt_tokens) > total_len:
+				raise ValueError(f"The prompt is {len(prompt_tokens)} tokens long, which doesn't fit in max_seq_len {self.max_seq_len}.")
+			if len(prompt_tokens) == total_len:
+				future.set_result((None, {'steps': 0, 'seconds': 0.0, 'tokens_per_second': None}))
+				return
+			with self._condition:
+				# The lowest free slot keeps the sequences in as few rows of the KV caches as possible, which the attention runs over.
+				slot = min(self._free_slots)
+				self._free_slots.remove(slot)
+				sequence = ActiveSequence(request, future, enqueued_at, slot, prompt_tokens, total_len, tokenizer)
+				self._active.append(sequence)
+			logits = self._generator.model.forward(
+				torch.tensor([prompt_tokens], dtype=torch.long),
+				torch.tensor([0]),
+				slots=torch.tensor([sequence.slot]),
+			)
+		except Exception as e:
+			if sequence is not None:
+				self._retire(sequence, e)
+			else:
+				self._retire_failed(future, e)
+			return
+		self._advance([sequence], logits)
+
+	# Runs one forward pass for the last token of every active sequence.
+	def _step(self):
+		sequences = list(self._active)
+		try:
+			logits = self._generator.model.forward(
+				torch.tensor([[sequence.tokens[-1]] for sequence in sequences], dtype=torch.long),
+				torch.tensor([len(sequence.tokens) - 1 for sequence in sequences]),
+				slots=torch.tensor([sequence.slot for sequence in sequences]),
+			)
+		except Exception as e:
+			for sequence in sequences:
+				self._retire(sequence, e)
+			return
+		with self._condition:
+			self._batch_sizes.append(len(sequences))
+		self._advance(sequences, logits)
+
+	# Picks the next token of each sequence, and retires the sequences that are done, the same way generate_internals() does.
+	def _advance(self, sequences, logits):
+		tokenizer = self._generator.tokenizer
+		for index, sequence in enumerate(sequences):
+			sequence.steps += 1
+			try:
+				# The position of the new token is the one that generate_internals() keeps the eos in, so the sequence ends there.
+				if len(sequence.tokens) >= sequence.total_len - 1:
+					self._retire(sequence)
+					continue
+				request = sequence.request
+				sequence_logits = logits[index:index + 1]
+				if request.repetition_penalty != 1.0:
+					# Note: like in generate_internals(), the repetition penalty also sees the padding after the tokens so far
+					# (which wraps around to the last token of the vocab), and the eos at the end of the row.
+					penalty_tokens = torch.tensor([sequence.tokens + [tokenizer.pad_id, tokenizer.eos_id]], dtype=torch.long)
+					sequence_logits = apply_repetition_penalty(sequence_logits, penalty_tokens, request.repetition_penalty)
+				next_token = int(sample_next_token(sequence_logits, request.temperature, request.top_p, request.top_k, request.sampler).reshape(-1)[0])
+				if next_token == tokenizer.eos_id:
+					self._retire(sequence)
+					continue
+				sequence.tokens.append(next_token)
+				sequence.newline_count += sequence.decoder.add([next_token]).count("\n")
+				# Stop once the sequence has started a new line.
+				if sequence.newline_count > sequence.prompt_newline_count:
+					self._retire(sequence)
+			except Exception as e:
+				self._retire(sequence, e)
+
+	# Note: this can be called again for a sequence that was already retired, if retiring it failed, to fail its future instead.
+	def _retire(self, sequence, exception=None):
+		with self._condition:
+			if sequence in self._active:
+				self._active.remove(sequence)
+				self._free_slots.append(sequence.slot)
+		if exception is not None:
+			self._retire_failed(sequence.future, exception)
+			return
+		seconds = time.monotonic() - sequence.started_at
+		# The incremental decoding can hold back an incomplete character at the end, so the final text is decoded in full, once.
+		decoded = self._generator.tokenizer.decode(sequence.tokens)
+		sequence.future.set_result((decoded, {
+			'steps': sequence.steps,
+			'seconds': seconds,
+			'tokens_per_second': sequence.steps / seconds if seconds > 0 else None,
+		}))
+		with self._condition:
+			self._latencies.append(time.monotonic() - sequence.enqueued_at)
+			self._completed_count += 1
+			self._generated_tokens += sequence.steps
+
+	def _retire_failed(self, future, exception):
+		if future.done():
+			return
+		future.set_exception(exception)
+		with self._condition:
+			self._completed_count += 1
+
+	def get_stats(self):
+		with self._condition:
+			latencies = sorted(self._latencies)
+			batch_sizes = list(self._batch_sizes)
+			completed_count = self._completed_count
+			generated_tokens = self._generated_tokens
+			busy_seconds = self._busy_seconds
+			queue_depth = len(self._queue)
+			active_count = len(self._active)
+		uptime = time.monotonic() - self._started_at
+		return {
+			'max_batch_size': self.max_batch_size,
+			'completed_requests': completed_count,
+			'queue_depth': queue_depth,
+			'active_sequences': active_count,
+			'requests_per_second': completed_count / uptime if uptime > 0 else None,
+			# Note: this is over the time that the scheduler was generating, so it's the throughput under load.
+			'tokens_per_second': generated_tokens / busy_seconds if busy_seconds > 0 else None,
+			'mean_batch_size': sum(batch_sizes) / len(batch_sizes) if batch_sizes else None,
+			'p50_latency_seconds': latencies[int(0.50 * (len(latencies) - 1))] if latencies else None,
+			'p99_latency_seconds': latencies[int(0.99 * (len(latencies) - 1))] if latencies else None,
+		}
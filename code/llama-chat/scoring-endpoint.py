@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Scores prompts with a LLaMA model on CPU, for measurements that only need the next-token logits of a few label tokens.
+# Unlike endpoint.py, this doesn't generate anything: it's a single forward pass per batch of prompts.
+
+from flask import Flask, request
+import fire
+import pickle
+import base64
+import torch
+import llamahf
+from metrics import ServerMetrics, RequestLog, BATCH_SIZE_BUCKETS, TOKEN_COUNT_BUCKETS
+
+app = Flask(__name__)
+
+METRICS = ServerMetrics()
+METRICS.instrument_flask_app(app)
+
+log_request = RequestLog()
+
+class Scorer:
+	def __init__(self, model_name, max_batch_size, max_seq_len):
+		self.model_name = model_name
+		self.max_batch_size = max_batch_size
+		self.max_seq_len = max_seq_len
+		self.tokenizer = llamahf.LLaMATokenizer.from_pretrained(model_name)
+		self.model = llamahf.LLaMAForCausalLM.from_pretrained(model_name, low_cpu_mem_usage=True)
+		self.model.to('cpu')
+		self.model.eval()
+
+	# Note: sentencepiece marks the start of a word with '▁', so 'high' maps to the id of '▁high'.
+	#       Words that don't have their own piece map to their first piece.
+	def get_target_token_ids(self, target_tokens):
+		if target_tokens == 'ALL':
+			return None
+		return [self.tokenizer.sp_model.encode(target_token)[0] for target_token in target_tokens]
+
+	# Returns the next-token logits after each prompt, restricted to target_token_ids (or all of them if it's None).
+	# Prompts that don't fit get None instead.
+	@torch.inference_mode()
+	def __call__(self, prompts, target_token_ids=None):
+		encoded_prompts = [self.tokenizer(prompt)['input_ids'] for prompt in prompts]
+		for encoded_prompt in encoded_prompts:
+			METRICS.observe('tokens_per_prompt', len(encoded_prompt), buckets=TOKEN_COUNT_BUCKETS, model=self.model_name)
+		results = [None] * len(prompts)
+		# Sorting by length keeps the padding within each batch small.
+		order = sorted(
+			(index for index, encoded_prompt in enumerate(encoded_prompts) if len(encoded_prompt) <= self.max_seq_len),
+			key=lambda index: len(encoded_prompts[index]),
+		)
+		if target_token_ids is None:
+			output_weight = self.model.lm_head.weight
+		else:
+			output_weight = self.model.lm_head.weight[target_token_ids]
+		for batch_start in range(0, len(order), self.max_batch_size):
+			batch_indices = order[batch_start:batch_start + self.max_batch_size]
+			METRICS.observe('batch_size', len(batch_indices), buckets=BATCH_SIZE_BUCKETS, model=self.model_name)
+			lengths = torch.tensor([len(encoded_prompts[index]) for index in batch_indices])
+			input_ids = torch.zeros((len(batch_indices), int(lengths.max())), dtype=torch.long)
+			attention_mask = torch.zeros_like(input_ids)
+			for row, index in enumerate(batch_indices):
+				input_ids[row, :lengths[row]] = torch.tensor(encoded_prompts[index])
+				attention_mask[row, :lengths[row]] = 1
+			# Only run the decoder, and apply the output layer to the last real position of each prompt.
+			hidden_states = self.model.model(input_ids=input_ids, attention_mask=attention_mask, use_cache=False)[0]
+			last_hidden_states = hidden_states[torch.arange(len(batch_indices)), lengths - 1]
+			logits = torch.matmul(last_hidden_states, output_weight.T).float()
+			for row, index in enumerate(batch_indices):
+				results[index] = logits[row].clone()
+		return results
+
+@app.route("/score", methods=['POST'])
+def score():
+	if not (
+		type(request.json) == dict
+		and 'prompts' in request.json
+		and type(request.json['prompts']) == list
+		and all(type(prompt) == str for prompt in request.json['prompts'])
+		and 'model_name' in request.json
+		and type(request.json['model_name']) == str
+		and 'target_tokens' in request.json
+		and (
+			request.json['target_tokens'] == 'ALL'
+			or (
+				type(request.json['target_tokens']) == list
+				and all(type(target_token) == str for target_token in request.json['target_tokens'])
+			)
+		)
+	):
+		return {"error":"malformed request"}, 400
+	log_request('Got request for', len(request.json['prompts']), 'prompts')
+
+	if request.json['model_name'] != SCORER.model_name:
+		return {"error": f"This server only has model '{SCORER.model_name}' loaded, not '{request.json['model_name']}'."}
+
+	target_token_ids = SCORER.get_target_token_ids(request.json['target_tokens'])
+	results = SCORER(request.json['prompts'], target_token_ids)
+	too_large_count = sum(result is None for result in results)
+	if too_large_count > 0:
+		METRICS.count('errors', too_large_count, route='/score', model=SCORER.model_name, error='TOO_LARGE')
+
+	return {
+		'output': [
+			base64.b64encode(pickle.dumps(result)).decode('utf-8') if result is not None else None
+			for result in results
+		],
+		'errors': [None if result is not None else 'TOO_LARGE' for result in results],
+		'error': None,
+		'target_token_ids': target_token_ids,
+	}
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+	return METRICS.to_dict()
+
+def main(
+		port: int,
+		model_name: str = 'decapoda-research/llama-7b-hf',
+		max_batch_size: int = 16,
+		max_seq_len: int = 2048,
+		threads: int = None,
+		quiet: bool = False,
+):
+	global SCORER
+	log_request.verbose = not quiet
+	if threads is not None:
+		torch.set_num_threads(threads)
+	SCORER = Scorer(model_name, max_batch_size, max_seq_len)
+	METRICS.register_gauge('loaded_model_bytes', lambda: sum(
+		tensor.numel() * tensor.element_size()
+		for tensor in list(SCORER.model.parameters()) + list(SCORER.model.buffers())
+	))
+
+	app.run(port=port)
+
+if __name__ == "__main__":
+	fire.Fire(main)
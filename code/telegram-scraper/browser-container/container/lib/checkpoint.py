@@ -0,0 +1,46 @@
+import os
+import pickle
+
+# An append-only file of pickled records.
+# Each append is flushed and fsync'ed, so after a crash or preemption at most the record being written is lost.
+# A torn record at the end of the file is cut off when the log is read back.
+class CheckpointLog:
+	def __init__(self, filename):
+		self.filename = filename
+
+	def exists(self):
+		return os.path.exists(self.filename)
+
+	def read_records(self) -> list:
+		records = []
+		if not self.exists():
+			return records
+		with open(self.filename, 'rb') as infile:
+			last_good_offset = 0
+			while True:
+				try:
+					records.append(pickle.load(infile))
+				except EOFError:
+					break
+				except (pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+					# Note: a truncated pickle can surface as pretty much any of these.
+					print(f"Discarding a torn record at the end of checkpoint '{self.filename}' (offset {last_good_offset}).")
+					break
+				last_good_offset = infile.tell()
+		if last_good_offset != os.path.getsize(self.filename):
+			# Cut off the torn record, so new records don't end up after garbage.
+			with open(self.filename, 'r+b') as outfile:
+				outfile.truncate(last_good_offset)
+		return records
+
+	def append(self, record):
+		with open(self.filename, 'ab') as outfile:
+			pickle.dump(record, outfile)
+			outfile.flush()
+			os.fsync(outfile.fileno())
+
+	def remove(self):
+		try:
+			os.remove(self.filename)
+		except FileNotFoundError:
+			pass
@@ -0,0 +1,108 @@
+import json
+import resource
+import time
+from functools import wraps
+from contextlib import contextmanager
+from datetime import datetime, timezone
+# Note: lib/metrics.py is a symlink to code/common/metrics.py, so the latency histograms are the same as the ones of the model servers.
+from lib.metrics import Histogram, LATENCY_BUCKETS
+
+
+def _get_peak_memory_bytes():
+	# Note: ru_maxrss is reported in kilobytes on Linux. It's the peak of the whole process so far, so for a stage it's an upper bound.
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageStats:
+	def __init__(self, name):
+		self.name = name
+		self.calls = 0
+		self.wall_time = 0.0
+		self.peak_memory_bytes = None
+		self.counters = {}
+		self.latencies = {}
+
+	def count(self, counter, amount=1):
+		self.counters[counter] = self.counters.get(counter, 0) + amount
+
+	def observe_latency(self, histogram_name, seconds):
+		if histogram_name not in self.latencies:
+			self.latencies[histogram_name] = Histogram(LATENCY_BUCKETS)
+		self.latencies[histogram_name].observe(seconds)
+
+	def get_ratio(self, numerator, denominator):
+		total = self.counters.get(numerator, 0) + self.counters.get(denominator, 0)
+		if total == 0:
+			return None
+		return self.counters.get(numerator, 0) / total
+
+	def to_dict(self):
+		result = {
+			'calls': self.calls,
+			'wall_time_seconds': self.wall_time,
+			'peak_memory_bytes': self.peak_memory_bytes,
+			'counters': dict(self.counters),
+			'latencies_seconds': {name: histogram.to_dict() for name, histogram in self.latencies.items()},
+		}
+		if 'items' in self.counters and self.wall_time > 0:
+			result['items_per_second'] = self.counters['items'] / self.wall_time
+		if 'cache_hits' in self.counters or 'cache_misses' in self.counters:
+			result['cache_hit_rate'] = self.get_ratio('cache_hits', 'cache_misses')
+		if 'dedup_hits' in self.counters or 'dedup_misses' in self.counters:
+			result['dedup_ratio'] = self.get_ratio('dedup_hits', 'dedup_misses')
+		return result
+
+
+# Collects per-stage timings and counters of a single run, and writes them out as a JSON report.
+class RunStats:
+	def __init__(self):
+		self.started_at = datetime.now(timezone.utc)
+		self._start_time = time.perf_counter()
+		self.stages = {}
+
+	def __getitem__(self, stage_name):
+		if stage_name not in self.stages:
+			self.stages[stage_name] = StageStats(stage_name)
+		return self.stages[stage_name]
+
+	@contextmanager
+	def stage(self, stage_name):
+		stage = self[stage_name]
+		stage.calls += 1
+		start_time = time.perf_counter()
+		try:
+			yield stage
+		finally:
+			stage.wall_time += time.perf_counter() - start_time
+			stage.peak_memory_bytes = _get_peak_memory_bytes()
+
+	@contextmanager
+	def timed(self, stage_name, histogram_name):
+		start_time = time.perf_counter()
+		try:
+			yield
+		finally:
+			self[stage_name].observe_latency(histogram_name, time.perf_counter() - start_time)
+
+	# Decorator version of stage(), for wrapping a whole function.
+	def instrument(self, stage_name):
+		def decorator(function):
+			@wraps(function)
+			def wrapper(*args, **kwargs):
+				with self.stage(stage_name):
+					return function(*args, **kwargs)
+			return wrapper
+		return decorator
+
+	def to_dict(self):
+		return {
+			'started_at': self.started_at.isoformat(),
+			'finished_at': datetime.now(timezone.utc).isoformat(),
+			'wall_time_seconds': time.perf_counter() - self._start_time,
+			'peak_memory_bytes': _get_peak_memory_bytes(),
+			'stages': {name: stage.to_dict() for name, stage in self.stages.items()},
+		}
+
+	def write_report(self, filename):
+		with open(filename, 'w') as outfile:
+			json.dump(self.to_dict(), outfile, indent='\t')
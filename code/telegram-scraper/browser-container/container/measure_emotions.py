@@ -5,6 +5,8 @@
 
 import os
 import sys
+import re
+import unicodedata
 from glob import glob
 import json
 from collections import namedtuple
@@ -18,10 +20,16 @@ import numpy as np
 from math import inf
 
 BERT_MODELS = ('bert-base-multilingual-cased','DeepPavlov/rubert-base-cased')
-LLAMA_MODELS = ()
+# Note: scoring with LLaMA needs scoring-endpoint.py from llama-chat running on LLAMA_ENDPOINT_URL, so it's opt-in with USE_LLAMA_MODELS.
+LLAMA_MODELS = ('decapoda-research/llama-7b-hf',) if os.environ.get('USE_LLAMA_MODELS') in ("1", "y", "Y", "yes", "true", "True") else ()
 
 MODELS = BERT_MODELS + LLAMA_MODELS
 
+BERT_ENDPOINT_URL = 'http://localhost:18002'
+LLAMA_ENDPOINT_URL = 'http://localhost:18003'
+# The number of prompts that are sent to the LLaMA endpoint in a single /score request.
+LLAMA_PREFETCH_BATCH_SIZE = 256
+
 HEURISTICS = (
 	".\n" + "anger level: [MASK]",
 	".\n" + "contempt level: [MASK]",
@@ -38,6 +46,8 @@ if os.environ.get('REALLY_PUSH_JOBS_TO_QUEUE') in ("1", "y", "Y", "yes", "true",
 	raise Exception('measurement code should not REALLY_PUSH_JOBS_TO_QUEUE')
 
 from send_comment_jobs import DATABASE, IS_QUICK_RUN, IS_EPHEMERAL_RUN, IS_LESS_VERBOSE_RUN, REALLY_PUSH_JOBS_TO_QUEUE, extract_export, BubbleHTMLParser, ChannelPostHTMLParser
+from lib.instrumentation import RunStats
+from lib.checkpoint import CheckpointLog
 
 FULL_RUN = os.environ.get('FULL_RUN') in ("1", "y", "Y", "yes", "true", "True")
 DONT_UNPICKLE = os.environ.get('DONT_UNPICKLE') in ("1", "y", "Y", "yes", "true", "True")
@@ -81,6 +91,16 @@ ANALYSIS_FEATURES = [
 
 QUICK_CACHE_PREFIX = '../../data/.QUICK_CACHE'
 
+RUN_REPORT_FILENAME = '../../data/run_report.json'
+
+# How many finished files get_raw_measurements collects before appending them to its checkpoint.
+RAW_MEASUREMENTS_CHECKPOINT_INTERVAL = 10
+if 'RAW_MEASUREMENTS_CHECKPOINT_INTERVAL' in os.environ:
+	RAW_MEASUREMENTS_CHECKPOINT_INTERVAL = int(os.environ['RAW_MEASUREMENTS_CHECKPOINT_INTERVAL'])
+
+# Note: set LESS_VERBOSE_RUN to turn off the per-item prints. The timings and counters end up in the run report either way.
+RUN_STATS = RunStats()
+
 
 MINIMIZATION_STEPS_COUNT = 6
 MINIMIZATION_STEPS = tuple(
@@ -250,12 +270,18 @@ def minimize_squared_errors(points):
 	return get_squared_errors(points, origin, current_direction, get_projected_values_instead=True)
 
 
+# Note: this is only used to find texts that would get the same measurements, the texts sent to the models aren't changed.
+def normalize_textcontent(textcontent):
+	return normalize_textcontent._PATTERN_WHITESPACE.sub(' ', unicodedata.normalize('NFC', textcontent)).strip()
+normalize_textcontent._PATTERN_WHITESPACE = re.compile(r'\s+')
+
 def get_feature_matches(text, include_analysis_features=False):
 	if include_analysis_features:
 		return [feature(text) for feature in FEATURES + ANALYSIS_FEATURES]
 	else:
 		return [feature(text) for feature in FEATURES]
 
+@RUN_STATS.instrument('extract_outerhtmls')
 def extract_outerhtmls():
 	cache_flag = 'OUTERHTMLS'
 	if must_rebuild_cache(cache_flag):
@@ -276,10 +302,13 @@ def extract_textcontent(html_parser, message_id, outerhtml) -> str:
 
 	return bubble_content
 
+@RUN_STATS.instrument('extract_textcontents')
 def extract_textcontents():
 	cache_flag = 'TEXTCONTENTS'
 	if must_rebuild_cache(cache_flag):
 		rebuild_cache_pre(cache_flag)
+		# The checkpointed measurements are of the old textcontents.
+		get_raw_measurements_checkpoint_log().remove()
 
 		channel_post_parser = ChannelPostHTMLParser()
 		comment_parser = BubbleHTMLParser()
@@ -288,7 +317,9 @@ def extract_textcontents():
 		for filename in glob_files('*/*.comments.json'):
 			extracted_textcontents = {}
 			counter += 1
-			print(f"Parsing file number {counter}.")
+			RUN_STATS['extract_textcontents'].count('files')
+			if not IS_LESS_VERBOSE_RUN:
+				print(f"Parsing file number {counter}.")
 			# if IS_QUICK_RUN and counter < 1333:
 			# 	continue
 			with open(sys.argv[2] + '/' + filename, 'r') as file:
@@ -297,6 +328,7 @@ def extract_textcontents():
 				for message_id, outerhtmls in bubbles.items():
 					# TO-DO: actually choose a specific outerhtml
 					bubble_content = extract_textcontent(comment_parser, message_id, outerhtmls[0])
+					RUN_STATS['extract_textcontents'].count('items')
 					if bubble_content.filter_reason is not None:
 						if bubble_content.filter_reason not in total_filter_counts:
 							total_filter_counts[bubble_content.filter_reason] = 0
@@ -306,7 +338,8 @@ def extract_textcontents():
 
 			with open(sys.argv[2] + '/' + filename[:-5] + '.textcontents.json', 'w') as outfile:
 				json.dump(extracted_textcontents, outfile)
-			print(total_filter_counts)
+			if not IS_LESS_VERBOSE_RUN:
+				print(total_filter_counts)
 
 		with open(sys.argv[2] + '/' + 'total_filter_counts.json', 'w') as outfile:
 			json.dump(total_filter_counts, outfile)
@@ -314,61 +347,125 @@ def extract_textcontents():
 
 		rebuild_cache_post(cache_flag)
 
-def get_raw_measurement(model, textcontent, heuristic) -> tuple[object, str]:
-	# TODO: implement
+def get_cache_entry_filename(req_data):
 	CACHE_PATH = '../../data/request_cache'
 	if not os.path.exists(CACHE_PATH):
 		raise Exception("The location of the cache at '{CACHE_PATH}' does not exist.")
+	hash_id = sha1(req_data).hexdigest()
+	return CACHE_PATH + '/' + hash_id[:2] + '/' + hash_id[2:] + '.json'
+
+def post_request(url, req_data):
+	req = request.Request(
+		url=url,
+		headers={
+			"Content-Type": "application/json",
+		},
+		method='POST',
+		data=req_data
+	)
+	with RUN_STATS.timed('get_raw_measurements', 'request'):
+		resp = request.urlopen(req)
+		if not resp.status == 200:
+			raise ValueError("Got {resp.status} http response from model endpoint.")
+		return json.loads(resp.read().decode('utf-8'))
+
+def write_cache_entry(cache_entry_filename, req_dict, req_data, resp_body):
+	if not os.path.exists('/'.join(cache_entry_filename.split('/')[:-1])):
+		os.mkdir('/'.join(cache_entry_filename.split('/')[:-1]))
+	with open(cache_entry_filename, 'w') as outfile:
+		json.dump({
+			'request_data': base64.b64encode(req_data).decode('utf-8'),
+			'request_json': req_dict,
+			'response_body': resp_body,
+			'timestamp': datetime.now(timezone.utc).isoformat(),
+		}, outfile)
+
+# Response bodies that were fetched in a batch by prefetch_llama_measurements(), by cache entry filename.
+# They're cached already, but get_cached_response() takes them from here, so they still count as cache misses.
+PREFETCHED_RESPONSES = {}
+
+# Posts req_dict to the model endpoint at url, or gets the response from the request cache if it was made before.
+def get_cached_response(url, req_dict):
+	req_data = json.dumps(req_dict).encode('utf-8')
+	cache_entry_filename = get_cache_entry_filename(req_data)
+	if cache_entry_filename in PREFETCHED_RESPONSES:
+		RUN_STATS['get_raw_measurements'].count('cache_misses')
+		resp_body = PREFETCHED_RESPONSES.pop(cache_entry_filename)
+	elif os.path.exists(cache_entry_filename):
+		RUN_STATS['get_raw_measurements'].count('cache_hits')
+		with RUN_STATS.timed('get_raw_measurements', 'cache_read'), open(cache_entry_filename, 'r') as infile:
+			try:
+				cache_entry = json.load(infile)
+			except json.decoder.JSONDecodeError:
+				print(f"\nGot an error while reading cache file at '{cache_entry_filename}'. The file is likely broken.")
+				raise
+		resp_body = cache_entry['response_body']
+	else:
+		RUN_STATS['get_raw_measurements'].count('cache_misses')
+		resp_body = post_request(url, req_data)
+		write_cache_entry(cache_entry_filename, req_dict, req_data, resp_body)
+	return resp_body
+
+# LLaMA doesn't do masked prediction, so the prompt stops where the [MASK] was and the label is the next token.
+# Note: only the logits of the LABELS are requested, in that order. get_model_vocab() maps them accordingly.
+def get_llama_request_dict(model, textcontent, heuristic):
+	if not heuristic.endswith('[MASK]'):
+		raise ValueError(f"Expected the heuristic to end with '[MASK]', but got: '{heuristic}'.")
+	return {
+		"target_tokens": list(LABELS),
+		"model_name": model,
+		"prompts": [(textcontent + heuristic[:-len('[MASK]')]).rstrip(' ')],
+	}
+
+# Scores the textcontents that aren't in the request cache yet with as few /score requests as possible.
+# Each prompt is still cached under the request for just that prompt, the same as get_raw_measurement() makes,
+# so the cache doesn't depend on how the prompts happened to be batched.
+def prefetch_llama_measurements(model, textcontents, heuristic):
+	pending = {}
+	for textcontent in textcontents:
+		req_dict = get_llama_request_dict(model, textcontent, heuristic)
+		req_data = json.dumps(req_dict).encode('utf-8')
+		cache_entry_filename = get_cache_entry_filename(req_data)
+		if cache_entry_filename not in pending and cache_entry_filename not in PREFETCHED_RESPONSES and not os.path.exists(cache_entry_filename):
+			pending[cache_entry_filename] = (req_dict, req_data)
+	pending_items = list(pending.items())
+	for batch_start in range(0, len(pending_items), LLAMA_PREFETCH_BATCH_SIZE):
+		batch = pending_items[batch_start:batch_start + LLAMA_PREFETCH_BATCH_SIZE]
+		resp_body = post_request(LLAMA_ENDPOINT_URL + '/score', json.dumps({
+			"target_tokens": list(LABELS),
+			"model_name": model,
+			"prompts": [req_dict['prompts'][0] for cache_entry_filename, (req_dict, req_data) in batch],
+		}).encode('utf-8'))
+		if ('error' in resp_body) and (resp_body['error'] is not None):
+			raise ValueError("Unknown structure of response body.")
+		RUN_STATS['get_raw_measurements'].count('batched_requests')
+		for index, (cache_entry_filename, (req_dict, req_data)) in enumerate(batch):
+			prompt_resp_body = {
+				'output': [resp_body['output'][index]],
+				'errors': [resp_body['errors'][index]],
+				'error': None,
+				'target_token_ids': resp_body['target_token_ids'],
+			}
+			write_cache_entry(cache_entry_filename, req_dict, req_data, prompt_resp_body)
+			PREFETCHED_RESPONSES[cache_entry_filename] = prompt_resp_body
+
+def get_raw_measurement(model, textcontent, heuristic) -> tuple[object, str]:
 	if model in BERT_MODELS:
 		# Fetch some logits
-		req_dict = {
+		resp_body = get_cached_response(BERT_ENDPOINT_URL + '/generate', {
 			"target_tokens": "ALL",
 			"model_name": model,
 			"text": textcontent + heuristic,
-		}
-		req_data = json.dumps(req_dict).encode('utf-8')
-		hash_id = sha1(req_data).hexdigest()
-
-		cache_entry_filename = CACHE_PATH + '/' + hash_id[:2] + '/' + hash_id[2:] + '.json'
-		if os.path.exists(cache_entry_filename):
-			with open(cache_entry_filename, 'r') as infile:
-				try:
-					cache_entry = json.load(infile)
-				except json.decoder.JSONDecodeError:
-					print(f"\nGot an error while reading cache file at '{cache_entry_filename}'. The file is likely broken.")
-					raise
-			resp_body = cache_entry['response_body']
-		else:
-			req = request.Request(
-				url='http://localhost:18002/generate',
-				headers={
-					"Content-Type": "application/json",
-				},
-				method='POST',
-				data=req_data
-			)
-			resp = request.urlopen(req)
-			if not resp.status == 200:
-				raise ValueError("Got {resp.status} http response from model endpoint.")
-			resp_body = json.loads(resp.read().decode('utf-8'))
-			if not os.path.exists('/'.join(cache_entry_filename.split('/')[:-1])):
-				os.mkdir('/'.join(cache_entry_filename.split('/')[:-1]))
-			with open(cache_entry_filename, 'w') as outfile:
-				json.dump({
-					'request_data': base64.b64encode(req_data).decode('utf-8'),
-					'request_json': req_dict,
-					'response_body': resp_body,
-					'timestamp': datetime.now(timezone.utc).isoformat(),
-				}, outfile)
+		})
 
 		if ('error' not in resp_body) or (resp_body['error'] is None):
 			if DONT_UNPICKLE:
 				return None, 'UNPICKLING_DISABLED'
-			output = pickle.loads(base64.b64decode(resp_body['output']))
-			print(output)
-			print(output.shape)
+			with RUN_STATS.timed('get_raw_measurements', 'unpickle'):
+				output = pickle.loads(base64.b64decode(resp_body['output']))
 			return output, None
 		elif 'error' in resp_body and resp_body['error'] == 'TOO_LARGE':
+			RUN_STATS['get_raw_measurements'].count('too_large')
 			return None, 'TOO_LARGE'
 		else:
 			raise ValueError("Unknown structure of response body.")
@@ -396,34 +493,116 @@ def get_raw_measurement(model, textcontent, heuristic) -> tuple[object, str]:
 		# print(resp_body['human_readable'])
 		# quit("Alrighty!")
 	elif model in LLAMA_MODELS:
-		raise NotImplementedError("LLaMA models haven't been implemented yet")
+		resp_body = get_cached_response(LLAMA_ENDPOINT_URL + '/score', get_llama_request_dict(model, textcontent, heuristic))
+
+		if ('error' not in resp_body) or (resp_body['error'] is None):
+			if resp_body['errors'][0] == 'TOO_LARGE':
+				RUN_STATS['get_raw_measurements'].count('too_large')
+				return None, 'TOO_LARGE'
+			if DONT_UNPICKLE:
+				return None, 'UNPICKLING_DISABLED'
+			with RUN_STATS.timed('get_raw_measurements', 'unpickle'):
+				output = pickle.loads(base64.b64decode(resp_body['output'][0]))
+			return output, None
+		else:
+			raise ValueError("Unknown structure of response body.")
 	else:
 		raise ValueError('This model is not recognized.')
 
+def get_raw_measurements_checkpoint_log():
+	return CheckpointLog(sys.argv[2] + '/.CHECKPOINT_RAW_MEASUREMENTS')
+
+@RUN_STATS.instrument('get_raw_measurements_checkpoint')
+def get_raw_measurements_checkpoint(heuristics):
+	checkpoint = get_raw_measurements_checkpoint_log()
+	if FULL_RUN:
+		checkpoint.remove()
+	# Note: runs with DONT_UNPICKLE measure None for every bubble, so their checkpoints can't be resumed by normal runs (or vice versa).
+	header = {
+		'models': MODELS,
+		'heuristics': tuple(heuristics),
+		'dont_unpickle': DONT_UNPICKLE,
+	}
+	records = checkpoint.read_records()
+	if len(records) > 0 and records[0] != header:
+		print(f"The checkpoint at '{checkpoint.filename}' was made with different models, heuristics or DONT_UNPICKLE. Starting over.")
+		checkpoint.remove()
+		records = []
+	if len(records) == 0:
+		checkpoint.append(header)
+		return checkpoint, []
+	return checkpoint, records[1:]
+
+# Note: progress is checkpointed to an append-only file every RAW_MEASUREMENTS_CHECKPOINT_INTERVAL files.
+#       A restarted run skips the files that are in there, and picks up their measurements from the checkpoint instead.
+#       The checkpoint is only for resuming an interrupted run, so it's removed once all files are done.
+@RUN_STATS.instrument('get_raw_measurements')
 def get_raw_measurements(heuristics):
 	total_counter = 0
 	filtered_counter = 0
 	selected_bubbles = {}
 	file_progress_counter = 0
+
+	# Quick and ephemeral runs don't leave anything behind, so they don't checkpoint either.
+	use_checkpoint = not IS_QUICK_RUN and not IS_EPHEMERAL_RUN
+	finished_filenames = set()
+	if use_checkpoint:
+		checkpoint, checkpoint_records = get_raw_measurements_checkpoint(heuristics)
+		for record in checkpoint_records:
+			finished_filenames.update(record['filenames'])
+			for message_id, measurements in record['selected_bubbles'].items():
+				if message_id not in selected_bubbles:
+					selected_bubbles[message_id] = {}
+				selected_bubbles[message_id].update(measurements)
+			total_counter += record['total_counter']
+			filtered_counter += record['filtered_counter']
+		if len(finished_filenames) > 0:
+			print(f"Resuming from checkpoint: {len(finished_filenames)} files and {len(selected_bubbles)} selected bubbles were already done.")
+		RUN_STATS['get_raw_measurements'].count('files_resumed', len(finished_filenames))
+	# Identical texts (spam, "+", lone emojis, bot replies) are measured only once per model and heuristic.
+	# This maps (model, normalized textcontent + heuristic) to the logits of the first bubble with that text.
+	deduplicated_logits = {}
+	for message_id, measurements in selected_bubbles.items():
+		for (model, heuristic), raw_measurement in measurements.items():
+			deduplicated_logits[(model, normalize_textcontent(raw_measurement.textcontent) + heuristic)] = raw_measurement.logits
+	# The files, measurements and counts since the last checkpoint.
+	pending_filenames = []
+	pending_bubbles = {}
+	pending_total_counter = 0
+	pending_filtered_counter = 0
+
 	for filename in glob_files('*/*.comments.textcontents.json'):
 	# for filename in ('readovkanews/4307796430.comments.textcontents.json',):
 		file_progress_counter += 1
 		if IS_QUICK_RUN and file_progress_counter < 102:
 			continue
+		if filename in finished_filenames:
+			continue
+		RUN_STATS['get_raw_measurements'].count('files')
 		with open(sys.argv[2] + '/' + filename, 'r') as file:
 			bubbles = json.load(file)
 
 		for heuristic in heuristics:
 			for model in MODELS:
+				if model in LLAMA_MODELS:
+					# The bubbles below are measured one by one, so their LLaMA prompts are sent in batches up front.
+					prefetch_llama_measurements(model, [
+						bubble['textcontent'] for bubble in bubbles.values()
+						if bubble['filter_reason'] is None
+						and sum(get_feature_matches(bubble['textcontent'])) > 0
+						and (model, normalize_textcontent(bubble['textcontent']) + heuristic) not in deduplicated_logits
+					], heuristic)
 				for message_id, bubble in bubbles.items():
 					if bubble['filter_reason'] is not None:
 						filtered_counter +=1
+						pending_filtered_counter += 1
 						continue
 					feature_matches = get_feature_matches(bubble['textcontent'])
 					if sum(feature_matches) > 0:
-						print('─'*80)
-						print(message_id, bubble['bubble_type'])
-						print(bubble['textcontent'])
+						if not IS_LESS_VERBOSE_RUN:
+							print('─'*80)
+							print(message_id, bubble['bubble_type'])
+							print(bubble['textcontent'])
 						# # Note: there actually seem to be duplicates, so don't raise an error, just overwrite them with one of the versions.
 						# #       Contents are the same anyways.
 						# # Update: Actually I think I fixed this, I think this was caused by it trying to store the results of multiple models in the same place.
@@ -431,28 +610,58 @@ def get_raw_measurements(heuristics):
 						# 	raise ValueError(f"Encountered duplicate message_id: '{message_id}'.")
 						if message_id not in selected_bubbles:
 							selected_bubbles[message_id] = {}
-						output, error = get_raw_measurement(model, bubble['textcontent'], heuristic)
-						if error is not None and output is not None:
-							raise ValueError("Expected either an error OR output logits.")
-						elif error is not None:
-							selected_bubbles[message_id][(model, heuristic)] = RawMeasurement(bubble['textcontent'], None)
-						elif output is not None:
-							selected_bubbles[message_id][(model, heuristic)] = RawMeasurement(bubble['textcontent'], output)
+						deduplication_key = (model, normalize_textcontent(bubble['textcontent']) + heuristic)
+						if deduplication_key in deduplicated_logits:
+							RUN_STATS['get_raw_measurements'].count('dedup_hits')
+							selected_bubbles[message_id][(model, heuristic)] = RawMeasurement(bubble['textcontent'], deduplicated_logits[deduplication_key])
 						else:
-							# This can't happen
-							raise ValueError("There's probably a type somewhere.")
-						print('files processed:', file_progress_counter)
+							RUN_STATS['get_raw_measurements'].count('dedup_misses')
+							output, error = get_raw_measurement(model, bubble['textcontent'], heuristic)
+							if error is not None and output is not None:
+								raise ValueError("Expected either an error OR output logits.")
+							elif error is not None:
+								selected_bubbles[message_id][(model, heuristic)] = RawMeasurement(bubble['textcontent'], None)
+							elif output is not None:
+								selected_bubbles[message_id][(model, heuristic)] = RawMeasurement(bubble['textcontent'], output)
+							else:
+								# This can't happen
+								raise ValueError("There's probably a type somewhere.")
+							deduplicated_logits[deduplication_key] = selected_bubbles[message_id][(model, heuristic)].logits
+						if message_id not in pending_bubbles:
+							pending_bubbles[message_id] = {}
+						pending_bubbles[message_id][(model, heuristic)] = selected_bubbles[message_id][(model, heuristic)]
+						RUN_STATS['get_raw_measurements'].count('items')
+						if not IS_LESS_VERBOSE_RUN:
+							print('files processed:', file_progress_counter)
 					total_counter += 1
-					if total_counter % 100 == 0:
+					pending_total_counter += 1
+					if total_counter % 100 == 0 and not IS_LESS_VERBOSE_RUN:
 						print(f"selected: {len(selected_bubbles)}\ttotal: {total_counter}\tfiltered_counter: {filtered_counter}")
 					# if IS_QUICK_RUN and total_counter > 100000:
 					# 	return selected_bubbles
 
 		print('files processed:', file_progress_counter)
-		print(f"selected: {len(selected_bubbles)}\ttotal: {total_counter}\tfiltered_counter: {filtered_counter}")
+		print(f"selected: {len(selected_bubbles)}\ttotal: {total_counter}\tfiltered_counter: {filtered_counter}\tunique measurements: {len(deduplicated_logits)}")
 		if IS_QUICK_RUN and file_progress_counter > 103:
 			return selected_bubbles
 
+		pending_filenames.append(filename)
+		if use_checkpoint and len(pending_filenames) >= RAW_MEASUREMENTS_CHECKPOINT_INTERVAL:
+			with RUN_STATS.timed('get_raw_measurements', 'checkpoint_write'):
+				checkpoint.append({
+					'filenames': pending_filenames,
+					'selected_bubbles': pending_bubbles,
+					'total_counter': pending_total_counter,
+					'filtered_counter': pending_filtered_counter,
+				})
+			pending_filenames = []
+			pending_bubbles = {}
+			pending_total_counter = 0
+			pending_filtered_counter = 0
+
+	if use_checkpoint:
+		checkpoint.remove()
+
 	return selected_bubbles
 
 def get_model_vocab(model):
@@ -475,7 +684,7 @@ def get_model_vocab(model):
 			}
 			req_data = json.dumps(req_dict).encode('utf-8')
 			req = request.Request(
-				url='http://localhost:18002/vocab',
+				url=BERT_ENDPOINT_URL + '/vocab',
 				headers={
 					"Content-Type": "application/json",
 				},
@@ -502,7 +711,8 @@ def get_model_vocab(model):
 		else:
 			raise ValueError("Unknown structure of response body.")
 	elif model in LLAMA_MODELS:
-		raise NotImplementedError()
+		# The LLaMA measurements only contain the logits of the LABELS, in that order.
+		return {label: index for index, label in enumerate(LABELS)}, None
 	else:
 		raise ValueError(f"unknown model name: '{model}'")
 
@@ -515,24 +725,29 @@ def get_model_vocabs():
 		results[model] = output
 	return results
 
+@RUN_STATS.instrument('project_onto_labels')
 def project_onto_labels(raw_measurements, vocabs):
 	results = {}
 	print(f"len(raw_measurements): {len(raw_measurements)}.")
-	for model in MODELS:
-		vocab = vocabs[model]
-		# Note: the value of labels that aren't in the vocab is represented as None here.
-		labels_zipped = tuple(zip(
+	# Each measurement is projected with the vocab of the model that made it, since the token ids differ per model.
+	# Note: the value of labels that aren't in the vocab is represented as None here.
+	labels_zipped_per_model = {
+		model: tuple(zip(
 			LABELS,
 			[vocab.get(label) for label in LABELS],
 		))
-		for message_id, raw_measurement in raw_measurements.items():
-			results[message_id] = {}
-			for (model, heuristic), raw_measurement_content in raw_measurement.items():
-				# print(logits)
-				if raw_measurement_content.logits is None:
-					results[message_id][(model, heuristic)] = UnifiedMeasurement(raw_measurement_content.textcontent, None)
-				else:
-					results[message_id][(model, heuristic)] = UnifiedMeasurement(raw_measurement_content.textcontent, [raw_measurement_content.logits[token_index] if token_index is not None else None for (label, token_index) in labels_zipped])
+		for model, vocab in vocabs.items()
+	}
+	for message_id, raw_measurement in raw_measurements.items():
+		results[message_id] = {}
+		for (model, heuristic), raw_measurement_content in raw_measurement.items():
+			# print(logits)
+			RUN_STATS['project_onto_labels'].count('items')
+			if raw_measurement_content.logits is None:
+				results[message_id][(model, heuristic)] = UnifiedMeasurement(raw_measurement_content.textcontent, None)
+			else:
+				labels_zipped = labels_zipped_per_model[model]
+				results[message_id][(model, heuristic)] = UnifiedMeasurement(raw_measurement_content.textcontent, [raw_measurement_content.logits[token_index] if token_index is not None else None for (label, token_index) in labels_zipped])
 
 	# # Make all sets of logits None when part already are
 	# for model in MODELS:
@@ -544,6 +759,7 @@ def project_onto_labels(raw_measurements, vocabs):
 	print(f"len(results): {len(results)}.")
 	return results
 
+@RUN_STATS.instrument('fit_normalization_lines')
 def fit_normalization_lines(unified_measurements, segmented_by):
 	# Some validation
 	segmentation_axes = {}
@@ -582,8 +798,9 @@ def fit_normalization_lines(unified_measurements, segmented_by):
 						(textcontent, [unified_logits[LABELS.index(label)].detach().numpy() for label in label_group])
 					)
 
-	print('═'*80)
-	from pprint import pprint; pprint(segmented_values)
+	if not IS_LESS_VERBOSE_RUN:
+		print('═'*80)
+		from pprint import pprint; pprint(segmented_values)
 
 	# # Set None values to None across the board
 	# segmented_nonevals = np.array([
@@ -614,13 +831,17 @@ def fit_normalization_lines(unified_measurements, segmented_by):
 	for key, segmented_value in segmented_values.items():
 		textcontents = np.array([subval[0] for subval in segmented_value if subval[1] is not None])
 		datapoints_combined = np.array([subval[1] for subval in segmented_value if subval[1] is not None])
-		print(key)
-		print(datapoints_combined)
+		if not IS_LESS_VERBOSE_RUN:
+			print(key)
+			print(datapoints_combined)
 		values = minimize_squared_errors(datapoints_combined)
 		sorted_values = sorted(values)
 		sorted_indices = np.array([sorted_values.index(value) for value in values])
 		percentiles = sorted_indices/len(sorted_indices) + 0.5/len(sorted_indices)
-		print(percentiles)
+		if not IS_LESS_VERBOSE_RUN:
+			print(percentiles)
+		RUN_STATS['fit_normalization_lines'].count('segments')
+		RUN_STATS['fit_normalization_lines'].count('items', len(datapoints_combined))
 		fitted_measurements[key] = (textcontents, percentiles)
 
 	return fitted_measurements
@@ -756,4 +977,8 @@ def main():
 	print("Measurements done!")
 
 if __name__ == '__main__':
-	main()
+	try:
+		main()
+	finally:
+		# Write the report even if the run crashed, so it's visible how far it got.
+		RUN_STATS.write_report(RUN_REPORT_FILENAME)